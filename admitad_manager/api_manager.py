@@ -11,6 +11,7 @@ from admitad import items, api
 from django.conf import settings
 
 from admitad_manager.models import *
+from direct.models import invalidate_actual_payment_sums
 from unify_context.models import Tariff, Position
 from unify_context.subidparser import BadSubid, SubIdParser
 
@@ -147,6 +148,7 @@ class AdmitadAPI(metaclass=Singleton):
         bulk_sync(new_models=actions, key_fields=['id'], filters=filter)  # сохраняем действия в базу
         bulk_sync(new_models=positions, key_fields=['id'],
                   filters=Q(action__in=actions))  # сохраняем позиции в действии
+        invalidate_actual_payment_sums()  # суммы оплат по критериям директа изменились
         result_str = f"Admitad stats collected {len(actions)} actions"
         logging.info(result_str)
         return result_str
@@ -11,6 +11,7 @@ import xmltodict
 
 from unify_context.models import Tariff, Position
 from unify_context.subidparser import BadSubid, SubIdParser
+from direct.models import invalidate_actual_payment_sums
 from advcake_manager.models import AdvCakeProgram, AdvCakeAction
 
 
@@ -90,6 +91,7 @@ class AdvCakeAPI(metaclass=Singleton):
         bulk_sync(new_models=actions, key_fields=['id'], filters=filter)  # сохраняем действия
         bulk_sync(new_models=positions, key_fields=['id'],
                   filters=Q(action__in=actions))  # сохраняем позиции в действии
+        invalidate_actual_payment_sums()  # суммы оплат по критериям директа изменились
 
     @classmethod
     def action_from_api_item(cls, advcake_item):
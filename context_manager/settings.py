@@ -79,6 +79,22 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'context_manager.wsgi.application'
 
+# Кеш. direct - кеш в базе, общий для всех процессов: его сбрасывают загрузчики действий admitad и advcake,
+# которые запускаются отдельно от сайта. Таблицу кеша надо создать при установке: python manage.py createcachetable
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'direct': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'direct_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,  # суммы оплат хранятся по пачкам критериев, записей немного
+            'CULL_FREQUENCY': 10,  # при переполнении удаляется 1/10 записей
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -122,6 +138,11 @@ BIDDER = {
 }
 
 
+# Хранение статистики директа
+DIRECT_STATS_RETENTION = {
+    'detail_days': 90,  # сколько дней хранится детальная статистика
+    'daily_days': 365,  # сколько дней хранится статистика по дням, дальше по неделям
+}
 
 # Настройки генератора фида
 FEED_GENERATOR = {
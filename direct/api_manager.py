@@ -3,37 +3,159 @@
 Идентификаторы объектов, которые еще не отправлены в директ отрицательны. Это сделано что бы после отправки можно поменять id (создать объекты с положительными id, которые получены из директа и удалить объекты с отрицательными id
 """
 import inspect
+import itertools
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, timedelta, datetime
 from functools import partial
 
 import pytz
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import OneToOneField
-from django.db.models.fields.reverse_related import ForeignObjectRel, OneToOneRel
+from django.db import connection, transaction
 from singleton import Singleton
 from yandex_direct_api import Api
 from direct.models import *
+from direct.partitions import ensure_partitions
+from direct.retention import detail_stats_from
+from direct.scheduler import UnitsScheduler
 
 
 class DirectAPI(metaclass=Singleton):
-    def __init__(self, accounts, sandbox=False):
-
-        self.ya_api = Api(accounts=accounts, sandbox=sandbox)
+    stats_chunk_size = 5000  # сколько строк отчета обрабатывается и записывается в базу за раз
+    page_size = 10000  # сколько объектов запрашивается в одном запросе get
+    report_workers = 50  # сколько отчетов ожидается одновременно в load_all_stats
+    stats_upsert = True  # обновлять статистику по естественному ключу, а не удалять и загружать заново
+    request_workers = 4  # сколько запросов к апи одновременно отправляется при разбиении на пачки
+    reset_history = False  # писать ли историю удаления объектов аккаунта перед первой загрузкой
+    # максимальное количество идентификаторов в одном запросе changes.check
+    check_changes_limits = {'CampaignIds': 3000, 'AdGroupIds': 10000, 'AdIds': 50000}
+    # максимальное количество идентификаторов в SelectionCriteria для suspend, resume, archive, moderate и т.п.
+    selection_ids_limits = {'campaigns': 1000, 'adgroups': 10000, 'ads': 10000, 'keywords': 10000}
+    # максимальное количество объектов в одном запросе add/update
+    write_limits = {'campaigns': 10, 'adgroups': 1000, 'ads': 1000, 'keywords': 1000, 'keywordbids': 10000}
+
+    def __init__(self, accounts, sandbox=False, use_aiohttp=False):
+        """
+        :param accounts: {login: token}
+        :param use_aiohttp: выполнять запросы через асинхронный клиент на aiohttp (direct.async_api) вместо
+        yandex_direct_api. Запросы из разных потоков выполняются одновременно в общем пуле соединений
+        """
+        # запросы выполняются через планировщик, который учитывает баллы каждого логина
+        self._transport = None  # асинхронный клиент, который надо закрыть после работы (см. close)
+        if use_aiohttp:
+            from direct.async_api import AsyncDirectTransport, SyncTransport
+            self._transport = SyncTransport(AsyncDirectTransport(accounts=accounts, sandbox=sandbox))
+            self.ya_api = UnitsScheduler(self._transport, units_reader=lambda api, login: api.units.get(login))
+        else:
+            self.ya_api = UnitsScheduler(Api(accounts=accounts, sandbox=sandbox))
         self.now = datetime.now(pytz.timezone('Europe/Moscow'))  # Сейчас по московскому времени
         self.today = self.now.date()
         self.yesterday = self.today - timedelta(days=1)
         self.account = None
+        self._dictionaries_lock = threading.Lock()  # справочники общие для всех аккаунтов, синхронизируем их по очереди
+        self._dictionaries_synced = threading.Event()  # справочники уже синхронизированы в этой загрузке
+
+    def close(self):
+        """
+        Закрывает сессию aiohttp и цикл событий асинхронного клиента, если он используется
+        После этого запросы через этот объект выполнять нельзя
+        """
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    def load_data(self, workers=1, report_queue=False):
+        """
+        Загружаем в локальную базу данныи из директа для всех аккаунтов
+        :param workers: сколько аккаунтов обрабатывать одновременно
+        :param report_queue: загружать статистику после загрузки всех аккаунтов через load_all_stats
+        :return: словарь {login: exception} аккаунтов, которые не удалось загрузить
+        """
+        self._dictionaries_synced.clear()  # справочники проверяются один раз за загрузку
+        errors = self.for_each_account('load_account', workers, "Load yandex data for %s", stats=not report_queue)
+        if report_queue and self.ya_api.sandbox == False:  # в песочница отчеты работают по-другому
+            errors.update(self.load_all_stats(exclude=errors))
+        return errors
 
-    def load_data(self):
-        # загружаем в локальную базу данныи из директа для всех аккаунтов
-        for account in Account.objects.exclude(disable=True).all():
-            logging.info("Load yandex data for %s" % account.login)
-            self.load_account(account)
+    def load_all_stats(self, exclude=()):
+        """
+        Загружает статистику всех аккаунтов. Отчеты запрашиваются сразу для всех аккаунтов, директ формирует их
+        параллельно. Каждый отчет сохраняется в базу, как только он готов
+        :param exclude: логины, которые не надо обрабатывать
+        :return: словарь {login: exception} аккаунтов, статистику которых не удалось загрузить
+        """
+        contexts = [self.account_context(account) for account in Account.objects.exclude(disable=True).all()
+                    if account.login not in exclude]
+        if not contexts:
+            return {}
+        errors = {}
+        # потоки только ждут отчеты, с базой работает текущий поток
+        with ThreadPoolExecutor(max_workers=min(len(contexts), self.report_workers)) as executor:
+            futures = {}
+            for context in contexts:
+                params = context._calc_stats_params()
+                futures[executor.submit(self.ya_api.reports, params, client_login=context.account.login)] = context
+            for future in as_completed(futures):
+                context = futures[future]
+                try:
+                    context.ingest_stats(future.result())
+                except Exception as e:
+                    logging.exception("Yandex stats failed for %s" % context.account.login)
+                    errors[context.account.login] = e
+        return errors
+
+    def for_each_account(self, method_name, workers=1, log_message="%s", **kwargs):
+        """
+        Вызывает метод method_name для всех активных аккаунтов.
+        Если workers > 1, каждый аккаунт обрабатывается в отдельном потоке со своей копией api (см. account_context).
+        Ошибка в одном аккаунте не останавливает обработку остальных.
+        :return: словарь {login: exception} аккаунтов, обработка которых завершилась ошибкой
+        """
+        accounts = list(Account.objects.exclude(disable=True).all())
+        errors = {}
+        if workers <= 1:
+            for account in accounts:
+                logging.info(log_message % account.login)
+                try:
+                    getattr(self, method_name)(account, **kwargs)
+                except Exception as e:
+                    logging.exception("Yandex sync failed for %s" % account.login)
+                    errors[account.login] = e
+            return errors
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self._run_in_context, method_name, account, log_message, **kwargs): account
+                       for account in accounts}
+            for future, account in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.exception("Yandex sync failed for %s" % account.login)
+                    errors[account.login] = e
+        return errors
+
+    def _run_in_context(self, method_name, account, log_message, **kwargs):
+        # выполняется в отдельном потоке
+        logging.info(log_message % account.login)
+        try:
+            getattr(self.account_context(account), method_name)(account, **kwargs)
+        finally:
+            # у каждого потока свое соединение с базой, закрываем его после завершения
+            connection.close()
 
-    def load_account(self, account):
-        # загружает данные из директа
+    def account_context(self, account):
+        """
+        Возвращает копию api для работы с одним аккаунтом. DirectAPI - синглтон и хранит текущий аккаунт в self.account,
+        поэтому для параллельной обработки каждому аккаунту нужна своя копия. Клиент апи и блокировки общие.
+        """
+        context = object.__new__(self.__class__)  # в обход метакласса Singleton
+        context.__dict__.update(self.__dict__)
+        context.account = account
+        return context
+
+    def load_account(self, account, stats=True):
+        # загружает данные из директа. stats - загружать ли статистику
         self.account = account
         # подгружаем постоянные справочники, типо регионов
         self.sync_dictionaries()
@@ -42,7 +164,7 @@ class DirectAPI(metaclass=Singleton):
         if len(changes) == 1:
             # запрашвиваем все данные, если синхронизации еще не было ( в changes только timestamp)
             # удаляем все существующие кампании с их содержанием
-            self.account.campaign_set.all().delete()
+            self.account.reset_direct(history=self.reset_history)
 
             self.get_campaigns()
             acc_campaign_ids = list(Campaign.objects.filter(account=self.account).values_list('id', flat=True))
@@ -69,27 +191,33 @@ class DirectAPI(metaclass=Singleton):
         self.account.save()
 
         # получаем статистику
-        if self.ya_api.sandbox == False:  # в песочница отчеты работают по-другому
+        if stats and self.ya_api.sandbox == False:  # в песочница отчеты работают по-другому
             self.get_stats()
 
     def sync_dictionaries(self):
         """
-        Проверяет наличие изменений в справочнике регионов и обновлеят регионы, если надо
+        Проверяет наличие изменений в справочнике регионов и обновлеят регионы, если надо.
+        Справочники общие для всех аккаунтов, поэтому проверяются один раз за загрузку с общей меткой времени.
+        Остальные аккаунты используют уже загруженные регионы
         :return:
         """
-
-        # если нет сохраненных изменений, загружаем все регионы
-        if not self.account.last_dictionaries_changes_time:
-            result = self.ya_api.checkDictionaries_changes()
-            self.get_regions()
-        else:
-            # получаем метку времени либо время последней синхронизации, либо текущее время
-            ts = self.account.last_dictionaries_changes_time.isoformat(timespec='seconds') + 'Z'
-            result = self.ya_api.checkDictionaries_changes({"Timestamp": ts})
-            if result['RegionsChanged'] == 'YES':
+        with self._dictionaries_lock:
+            if self._dictionaries_synced.is_set():
+                return
+            dictionary, created = Dictionary.objects.get_or_create(name='GeoRegions')
+            # если нет сохраненных изменений, загружаем все регионы
+            if not dictionary.last_changes_time:
+                result = self.ya_api.checkDictionaries_changes()
                 self.get_regions()
-        self.account.last_dictionaries_changes_time = result['Timestamp'][:-1]  # удаляе 'Z' с конца
-        self.account.save()
+            else:
+                # получаем метку времени либо время последней синхронизации, либо текущее время
+                ts = dictionary.last_changes_time.isoformat(timespec='seconds') + 'Z'
+                result = self.ya_api.checkDictionaries_changes({"Timestamp": ts})
+                if result['RegionsChanged'] == 'YES':
+                    self.get_regions()
+            dictionary.last_changes_time = result['Timestamp'][:-1]  # удаляе 'Z' с конца
+            dictionary.save()
+            self._dictionaries_synced.set()
 
     def get_changed_ids(self):
         """
@@ -127,33 +255,16 @@ class DirectAPI(metaclass=Singleton):
             changed_ads = child_changes['Modified'].get('AdIds', [])
 
         # получаем идентификаторы удаленных объектов
-        # получаем сущетсвующие идентификторы
-        existing_cmp_ids = list(Campaign.objects.values_list('id', flat=True))
-        existing_group_ids = list(AdGroup.objects.values_list('id', flat=True))
-        existing_ad_ids = list(TextAd.objects.values_list('id', flat=True))
-        # проверяем наличие изменений
-        cmp_check_results = {}
-        group_check_results = {}
-        ad_check_results = {}
-        if existing_cmp_ids:
-            cmp_check_results = self.ya_api.check_changes({'CampaignIds': existing_cmp_ids,
-                                                           "FieldNames": ["CampaignIds"],
-                                                           'Timestamp': last_timestamp, },
-                                                          client_login=self.account.login)
-        if existing_group_ids:
-            group_check_results = self.ya_api.check_changes({'AdGroupIds': existing_group_ids,
-                                                             "FieldNames": ["AdGroupIds"],
-                                                             'Timestamp': last_timestamp, },
-                                                            client_login=self.account.login)
-        if existing_ad_ids:
-            ad_check_results = self.ya_api.check_changes({'AdIds': existing_ad_ids,
-                                                          "FieldNames": ["AdIds"],
-                                                          'Timestamp': last_timestamp, },
-                                                         client_login=self.account.login)
+        # получаем сущетсвующие идентификторы объектов аккаунта (объекты с отрицательными id еще не созданы в директе)
+        existing_cmp_ids = list(Campaign.objects.filter(account=self.account, id__gt=0).values_list('id', flat=True))
+        existing_group_ids = list(
+            AdGroup.objects.filter(campaign__account=self.account, id__gt=0).values_list('id', flat=True))
+        existing_ad_ids = list(
+            TextAd.objects.filter(ad_group__campaign__account=self.account, id__gt=0).values_list('id', flat=True))
         # если id не найден, значит объект удален
-        deleted_campaigns = cmp_check_results.get('NotFound', {}).get('CampaignIds', [])
-        deleted_groups = group_check_results.get('NotFound', {}).get('AdGroupIds', [])
-        deleted_ads = ad_check_results.get('NotFound', {}).get('AdIds', [])
+        deleted_campaigns = self._check_not_found('CampaignIds', existing_cmp_ids, last_timestamp)
+        deleted_groups = self._check_not_found('AdGroupIds', existing_group_ids, last_timestamp)
+        deleted_ads = self._check_not_found('AdIds', existing_ad_ids, last_timestamp)
 
         return {'changed': {'campaigns': changed_campaigns,
                             'groups': changed_groups,
@@ -163,32 +274,158 @@ class DirectAPI(metaclass=Singleton):
                             'ads': deleted_ads},
                 'timestamp': server_timestamp}
 
+    def _check_not_found(self, ids_field, ids, last_timestamp):
+        """
+        Проверяет наличие объектов в директе пачками, которые допускает changes.check
+        :param ids_field: тип идентификаторов: CampaignIds, AdGroupIds или AdIds
+        :param ids: идентификаторы, которые надо проверить
+        :return: идентификаторы, которые не найдены в директе
+        """
+        def check(chunk):
+            return self.ya_api.check_changes({ids_field: chunk,
+                                              "FieldNames": [ids_field],
+                                              'Timestamp': last_timestamp, },
+                                             client_login=self.account.login)
+
+        not_found = []
+        for result in self.map_chunks(check, ids, self.check_changes_limits[ids_field]):
+            not_found.extend(result.get('NotFound', {}).get(ids_field, []))
+        return not_found
+
+    def map_chunks(self, func, items, chunk_size):
+        """
+        Делит items на пачки по chunk_size и вызывает func для каждой пачки. Пачки обрабатываются параллельно,
+        не больше request_workers одновременно. func не должна обращаться к базе, т.к. выполняется в другом потоке
+        :return: список результатов в порядке пачек
+        """
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        if len(chunks) <= 1 or self.request_workers <= 1:
+            return [func(chunk) for chunk in chunks]
+        with ThreadPoolExecutor(max_workers=self.request_workers) as executor:
+            return list(executor.map(func, chunks))
+
     def get_stats(self):
 
         # получаем отчет
         params = self._calc_stats_params()
-        report = self.ya_api.reports(params, client_login=self.account.login)
+        self.ingest_stats(self.ya_api.reports(params, client_login=self.account.login))
 
-        # удаляем старые данные
-        first_date = date.fromisoformat(report[0]['Date'])
-        deleted = DirectStats.objects.filter(date__gte=first_date,
-                                             campaign__account__login=self.account.login).delete()
-
-        # создаем объекты статистики
-        stats = self.parse_direct_report(report)
+    def ingest_stats(self, report, upsert=None):
+        """
+        Сохраняет отчет в базу, заменяя статистику за даты отчета
+        :param report: строки отчета
+        :param upsert: обновлять только изменившиеся строки по естественному ключу вместо удаления и повторной
+        загрузки. По умолчанию stats_upsert
+        """
+        if upsert is None:
+            upsert = self.stats_upsert
+        report = iter(report)
+        first_item = next(report, None)
+        if first_item is None:
+            logging.info("Yandex stats is empty")
+            return
 
-        # добавлем отсутствующие критерии
-        self._create_missed_criterions(stats)
+        # идентификаторы существующих критериев, пополняются по мере создания отсутствующих
+        criterion_ids = set(
+            Criterion.objects.filter(ad_group__campaign__account=self.account).values_list('id', flat=True))
 
-        # отправляем статистику в базу
-        DirectStats.objects.bulk_create(stats, batch_size=100)
+        first_date = date.fromisoformat(first_item['Date'])
+        # секции статистики за период отчета
+        ensure_partitions(first_date, self.yesterday)
+        with transaction.atomic():
+            if not upsert:
+                # удаляем старые данные
+                deleted = DirectStats.objects.filter(date__gte=first_date,
+                                                     campaign__account__login=self.account.login).delete()
+
+            # обрабатываем отчет пачками, что бы не держать его целиком в памяти
+            rows = itertools.chain([first_item], report)
+            chunks = iter(lambda: list(itertools.islice(rows, self.stats_chunk_size)), [])
+            # свернутые дни не загружаем, иначе они будут посчитаны дважды
+            date_from = detail_stats_from(self.account)
+            stats_chunks = self._track_last_date(self.parse_direct_report(chunk, date_from) for chunk in chunks)
+            if upsert:
+                self._upsert_stats(stats_chunks, first_date, criterion_ids)
+            else:
+                for stats in stats_chunks:
+                    # добавлем отсутствующие критерии
+                    self._create_missed_criterions(stats, criterion_ids)
+                    # отправляем статистику в базу
+                    fast_bulk_insert(DirectStats, stats)
+            # статистика после first_date заменена отчетом, поэтому последняя дата - последняя дата в отчете.
+            # Если все строки отброшены (например, в отчете только сегодняшний день), дату не трогаем, иначе
+            # следующая загрузка запросит статистику за все время
+            if self._last_stats_date is not None:
+                Account.objects.filter(pk=self.account.pk).update(last_stats_date=self._last_stats_date)
+                self.account.last_stats_date = self._last_stats_date
         logging.info("Yandex stats collected")
 
-    def _create_missed_criterions(self, stats):
+    def _track_last_date(self, stats_chunks):
+        # запоминает последнюю дату отчета, пока пачки обрабатываются
+        self._last_stats_date = None
+        for stats in stats_chunks:
+            if stats:
+                self._last_stats_date = stats[-1].date
+            yield stats
+
+    def _upsert_stats(self, stats_chunks, first_date, criterion_ids):
+        """
+        Сравнивает статистику с базой по естественному ключу (DirectStats.NATURAL_KEY): создает новые строки,
+        обновляет строки, у которых изменились клики или показы, удаляет строки, которых больше нет в отчете.
+        Отчет отсортирован по дате, поэтому в памяти хранятся существующие строки только тех дат, которые еще
+        могут встретиться в следующих пачках
+        """
+        account_stats = DirectStats.objects.filter(campaign__account=self.account)
+        open_dates = {}  # {date: {key: (id, clicks, shows)}}
+        processed_dates = set()
+        for stats in stats_chunks:
+            if not stats:
+                continue
+            self._create_missed_criterions(stats, criterion_ids)
+            # загружаем существующие строки для новых дат
+            new_dates = {stat.date for stat in stats} - processed_dates
+            for row in account_stats.filter(date__in=new_dates).values_list('id', 'clicks', 'shows',
+                                                                              *DirectStats.NATURAL_KEY):
+                open_dates.setdefault(row[3], {})[row[3:]] = row[:3]
+            processed_dates |= new_dates
+
+            to_create = []
+            to_update = []
+            for stat in stats:
+                existing = open_dates.get(stat.date, {}).pop(stat.natural_key(), None)
+                if existing is None:
+                    to_create.append(stat)
+                elif existing[1:] != (stat.clicks, stat.shows):
+                    stat.id = existing[0]
+                    to_update.append(stat)
+            fast_bulk_insert(DirectStats, to_create)
+            DirectStats.objects.bulk_update(to_update, ['clicks', 'shows'], batch_size=1000)
+
+            # даты до последней в пачке закончились, оставшиеся строки удалены из директа
+            last_date = stats[-1].date
+            for finished_date in [d for d in open_dates if d < last_date]:
+                self._delete_stats_ids([id for id, clicks, shows in open_dates.pop(finished_date).values()])
+
+        for rest in open_dates.values():
+            self._delete_stats_ids([id for id, clicks, shows in rest.values()])
+        # даты, по которым в отчете нет ни одной строки, удаляем диапазонами между загруженными датами
+        bounds = [first_date - timedelta(days=1)] + sorted(processed_dates)
+        for start, end in zip(bounds, bounds[1:] + [None]):
+            if end is None:
+                account_stats.filter(date__gt=start).delete()
+            elif end - start > timedelta(days=1):
+                account_stats.filter(date__gt=start, date__lt=end).delete()
+
+    def _delete_stats_ids(self, ids, batch_size=900):
+        for i in range(0, len(ids), batch_size):
+            DirectStats.objects.filter(id__in=ids[i:i + batch_size]).delete()
+
+    def _create_missed_criterions(self, stats, kwd_ids=None):
         # добавлем отсутствующие критерии. Либо фраза удалена, либо критерий не управляется через API
         # получаем id существующих критериев
-        kwd_ids = set(
-            Criterion.objects.filter(ad_group__campaign__account=self.account).values_list('id', flat=True))
+        if kwd_ids is None:
+            kwd_ids = set(
+                Criterion.objects.filter(ad_group__campaign__account=self.account).values_list('id', flat=True))
         # создаем удаленные ключевые слова
         deleted_kwds = {}
         for stat in stats:
@@ -198,19 +435,18 @@ class DirectAPI(metaclass=Singleton):
                 deleted_kwds[kwd_id] = Criterion(id=stat.criterion_id, ad_group_id=stat.group_id)
         # отправляем ключи в базу
         Criterion.objects.bulk_create(list(deleted_kwds.values()), batch_size=100)
+        kwd_ids.update(deleted_kwds)
 
     def _calc_stats_params(self):
-        try:
-            last_stat = DirectStats.objects.filter(campaign__account=self.account).latest('date')
-        except ObjectDoesNotExist:
-            last_stat = None
+        # последняя дата статистики хранится в аккаунте и обновляется при загрузке отчета
+        last_stats_date = self.account.last_stats_date
 
         date_criteria = {}
         # Если данных нет, запрашиваем за весь период
-        if not last_stat:
+        if not last_stats_date:
             date_params = {"DateRangeType": "ALL_TIME"}
         # если есть за позавчера, в режиме авто: минимум 3 дня, не включая сегодя + дни, когда статистика корректировалась
-        elif last_stat.date >= self.yesterday - timedelta(days=1):
+        elif last_stats_date >= self.yesterday - timedelta(days=1):
             date_params = {"DateRangeType": "AUTO"}
         # иначе с того дня, как была снята статистика - 7 дней, что б учесть все корректировки
         else:
@@ -218,7 +454,7 @@ class DirectAPI(metaclass=Singleton):
                 "DateRangeType": "CUSTOM_DATE",
             }
             date_criteria = {
-                "DateFrom": (last_stat.date - timedelta(days=7)).isoformat(),
+                "DateFrom": (last_stats_date - timedelta(days=7)).isoformat(),
                 "DateTo": self.yesterday.isoformat()
             }
 
@@ -253,13 +489,15 @@ class DirectAPI(metaclass=Singleton):
         params['SelectionCriteria'].update(date_criteria)
         return params
 
-    def parse_direct_report(self, report):
+    def parse_direct_report(self, report, date_from=None):
         stats = []
         for item in report:
             stat, update_fields = DirectStats.deserialize(item)
             # данные за сегодня не нужны
             if stat.date >= self.today:
                 continue
+            if date_from and stat.date < date_from:
+                continue
             stats.append(stat)
         return stats
 
@@ -283,21 +521,24 @@ class DirectAPI(metaclass=Singleton):
         if ids is not None:
             params["SelectionCriteria"]['Ids'] = ids
             filter['id__in'] = ids
-        results = self.ya_api.get_campaigns(params, client_login=self.account.login)
-
-        text_campaigns = []
-        other_campaigns = []
-        for campaign in results:
-            campaign['AccountId'] = self.account.login
-            # добавляем логин в параметры
-            if campaign['Type'] == 'TEXT_CAMPAIGN':
-                text_campaigns.append(campaign)
-            else:
-                other_campaigns.append(campaign)
-        TextCampaign.sync_response(text_campaigns, filter=filter)
         # не нужно менять текстовые кампании, поэтому добавляем условие в фильтры
-        filter['type__in'] = {choice[0] for choice in Campaign.TYPE_CHOICES} - {'TEXT_CAMPAIGN'}
-        Campaign.sync_response(other_campaigns, filter=filter)
+        other_filter = dict(filter, type__in={choice[0] for choice in Campaign.TYPE_CHOICES} - {'TEXT_CAMPAIGN'})
+        text_campaign_ids = set()
+        other_campaign_ids = set()
+        for results in self.iter_pages(self.ya_api.get_campaigns, params):
+            text_campaigns = []
+            other_campaigns = []
+            for campaign in results:
+                campaign['AccountId'] = self.account.login
+                # добавляем логин в параметры
+                if campaign['Type'] == 'TEXT_CAMPAIGN':
+                    text_campaigns.append(campaign)
+                else:
+                    other_campaigns.append(campaign)
+            text_campaign_ids.update(TextCampaign.sync_response(text_campaigns, filter=filter, skip_deletes=True))
+            other_campaign_ids.update(Campaign.sync_response(other_campaigns, filter=other_filter, skip_deletes=True))
+        TextCampaign.delete_missing(filter, text_campaign_ids)
+        Campaign.delete_missing(other_filter, other_campaign_ids)
 
     def get_ad_groups(self, cmp_ids=None, group_ids=None):
         """
@@ -318,8 +559,7 @@ class DirectAPI(metaclass=Singleton):
         if group_ids:
             params['SelectionCriteria']['Ids'] = group_ids
             filter['id__in'] = group_ids
-        results = self.ya_api.get_adgroups(params, client_login=self.account.login)
-        AdGroup.sync_response(results, filter)
+        AdGroup.sync_pages(self.iter_pages(self.ya_api.get_adgroups, params), filter)
 
     def get_text_ads(self, cmp_ids=None, ad_ids=None):
         """
@@ -342,8 +582,7 @@ class DirectAPI(metaclass=Singleton):
         if ad_ids:
             params['SelectionCriteria']['Ids'] = ad_ids
             filter['id__in'] = ad_ids
-        results = self.ya_api.get_ads(params, client_login=self.account.login)
-        TextAd.sync_response(results, filter)
+        TextAd.sync_pages(self.iter_pages(self.ya_api.get_ads, params), filter)
 
     def get_keywords(self, cmp_ids=None, group_ids=None):
         """
@@ -365,25 +604,87 @@ class DirectAPI(metaclass=Singleton):
         if group_ids:
             params['SelectionCriteria']['AdGroupIds'] = group_ids
             filter['ad_group_id__in'] = group_ids
-        results = self.ya_api.get_keywords(params, client_login=self.account.login)
-        Keyword.sync_response(results, filter)
+        Keyword.sync_pages(self.iter_pages(self.ya_api.get_keywords, params), filter)
 
-    def send_bids(self, kwds):
-        """Отправляет ставки в базу"""
-        # группируем ключевые слова по логину
+    def iter_pages(self, method, params):
+        """
+        Запрашивает объекты по страницам (Page.Limit/Offset) и возвращает страницы по мере получения.
+        Последняя страница - та, на которой объектов меньше page_size
+        :param method: метод ya_api для получения объектов
+        """
+        offset = 0
+        while True:
+            page_params = dict(params, Page={'Limit': self.page_size, 'Offset': offset})
+            results = method(page_params, client_login=self.account.login)
+            yield results
+            if len(results) < self.page_size:
+                break
+            offset += self.page_size
+
+    def send_bids(self, kwds, workers=None, batch_size=900):
+        """
+        Отправляет ставки ключевых фраз в директ и сохраняет в базу.
+        Отправляются только ставки, которые отличаются от сохраненных в базе. Логины и сохраненные ставки загружаются
+        одним запросом с join на пачку фраз, ставки каждого логина делятся на пачки по write_limits['keywordbids'],
+        логины обрабатываются параллельно. В базу записываются только ставки, которые директ принял
+        :param kwds: ключевые фразы с новыми ставками
+        :param workers: сколько логинов обрабатывать одновременно, по умолчанию request_workers
+        :return: фразы, ставки которых не удалось установить, включая фразы, которых нет в базе
+        """
+        kwds = list(kwds)
+        stored = {}
+        for i in range(0, len(kwds), batch_size):
+            stored.update((id, (bid, login)) for id, bid, login in Keyword.objects.filter(
+                id__in=[kw.id for kw in kwds[i:i + batch_size]]).values_list('id', 'bid',
+                                                                             'ad_group__campaign__account__login'))
+        # группируем измененные ставки по логину
         data = {}
+        unknown = []
         for kw in kwds:
-            data.setdefault(
-                kw.ad_group.campaign.account.login,
-                {"KeywordBids": []}
-            )["KeywordBids"].append({"KeywordId": kw.id, "SearchBid": kw.bid * 10_000})
-        # для каждого логина устанавливаем ставки
-        for login, params in data.items():
-            results = self.ya_api.set_keywordbids(params, client_login=login)
-            logging.info("%s bids updated %s" % (len(results), login))
+            if kw.id not in stored:
+                # фразы нет в базе, логин неизвестен
+                unknown.append(kw)
+                continue
+            bid, login = stored[kw.id]
+            if kw.bid != bid:
+                data.setdefault(login, []).append(kw)
+        if unknown:
+            logging.error("%d keywords not found in db, bids skipped: %s" % (len(unknown), [kw.id for kw in unknown]))
+        if not data:
+            return unknown
+
+        def send(login):
+            # выполняется в отдельном потоке, без обращений к базе
+            def call(chunk):
+                try:
+                    return check_result_count(self.ya_api.set_keywordbids(
+                        {"KeywordBids": [{"KeywordId": kw.id, "SearchBid": kw.bid * 10_000} for kw in chunk]},
+                        client_login=login), chunk)
+                except Exception as e:
+                    logging.exception("bids request failed for %s" % login)
+                    return [e] * len(chunk)
+
+            results = []
+            for chunk_results in self.map_chunks(call, data[login], self.write_limits['keywordbids']):
+                results.extend(chunk_results)
+            return results
+
+        with ThreadPoolExecutor(max_workers=workers or self.request_workers) as executor:
+            login_results = dict(zip(data, executor.map(send, data)))
+
+        updated = []
+        failed = []
+        for login, results in login_results.items():
+            login_updated = [kw for kw, result in zip(data[login], results) if result_id(result) is not None]
+            logging.info("%s bids updated %s" % (len(login_updated), login))
+            updated.extend(login_updated)
+            failed.extend(kw for kw, result in zip(data[login], results) if result_id(result) is None)
+        if failed:
+            logging.error("%d of %d bids failed" % (len(failed), len(failed) + len(updated)))
         # сохраняем в базу
-        Keyword.objects.bulk_update(kwds, ['bid'], batch_size=900)
+        Keyword.objects.bulk_update(updated, ['bid'], batch_size=batch_size)
         logging.info("bids comitted to db")
+        return unknown + failed
 
     def get_regions(self):
         params = {
@@ -391,7 +692,9 @@ class DirectAPI(metaclass=Singleton):
         }
         results = self.ya_api.get_dictionaries(params)
 
-        Region.sync_response(results, filter={})
+        # иерархия пересчитывается, если регионы изменились или еще не посчитана
+        if Region.sync_cached(results) or not RegionTree.objects.exists():
+            Region.rebuild_tree()
 
     def create_text_campaigns(self, names):
         """
@@ -425,62 +728,97 @@ class DirectAPI(metaclass=Singleton):
         return campaigns
 
     def add_objects(self, obj_names, objs):
+        """
+        Создает объекты в директе и меняет их временные отрицательные id на полученные из директа
+        :return: список (объект, ошибка) объектов, которые не удалось создать. Они остаются в базе с отрицательным id
+        """
         if not objs:
-            return
+            return []
+        objs = list(objs)
         cls = objs[0].__class__
         service = obj_names.lower()
-        params = {obj_names: [o.serialize(exclude={'id'} | cls.exclude_serialize_fields) for o in objs]}
+        items = cls.serialize_many(objs, exclude={'id'} | cls.exclude_serialize_fields)
         # Отправляем запрос в Директ
-        ids = getattr(self.ya_api, '%s_%s' % ('add', service))(params, client_login=self.account.login)
-        for cmp, id in zip(objs, ids):
-            change_id(cmp, id)
+        results = self.dispatch_items(getattr(self.ya_api, '%s_%s' % ('add', service)), obj_names, items)
+        # меняем временные отрицательные id на полученные из директа
+        remap_ids(cls, {obj.id: result_id(result) for obj, result in zip(objs, results)
+                        if result_id(result) is not None})
+        return self._log_errors('add', obj_names, objs, results)
 
     def update_objects(self, obj_names, objs):
-
+        """
+        :return: список (объект, ошибка) объектов, которые не удалось обновить
+        """
         if not objs:
-            return
+            return []
+        objs = list(objs)
         cls = objs[0].__class__
         service = obj_names.lower()
-        params = {obj_names: [o.serialize(exclude=cls.exclude_serialize_update_fields) for o in objs]}
+        items = cls.serialize_many(objs, exclude=cls.exclude_serialize_update_fields)
         # Отправляем запрос в Директ
-        ids = getattr(self.ya_api, '%s_%s' % ('update', service))(params, client_login=self.account.login)
-        assert len(ids) == len(objs)
-        for new_id, obj in zip(ids, objs):
-            # если идентификатор изменился, меняем его
-            # todo: проверить тестом
-            if obj.id != id:
-                change_id(obj, new_id)
+        results = self.dispatch_items(getattr(self.ya_api, '%s_%s' % ('update', service)), obj_names, items)
+        # если идентификатор изменился, меняем его
+        remap_ids(cls, {obj.id: result_id(result) for obj, result in zip(objs, results)
+                        if result_id(result) is not None and obj.id != result_id(result)})
+        return self._log_errors('update', obj_names, objs, results)
 
     def change_object_states(self, obj_names, objs):
         # останавливает или включает объекты на основе стейта в базе
         if not objs:
-            return
-        cls = objs[0].__class__
+            return []
         service = obj_names.lower()
-        # останавливаем объекты
-        suspend_params = {"SelectionCriteria": {'Ids': [o.id for o in objs if o.state == 'SUSPENDED']}}
-        if suspend_params["SelectionCriteria"]['Ids']:
-            # Отправляем запрос в Директ
-            ids = getattr(self.ya_api, '%s_%s' % ('suspend', service))(suspend_params, client_login=self.account.login)
-            assert len(ids) == len(suspend_params["SelectionCriteria"]['Ids'])
-        # возобновляем объекты
-        resume_params = {"SelectionCriteria": {'Ids': [o.id for o in objs if o.state == 'ON']}}
-        if resume_params["SelectionCriteria"]['Ids']:
-            ids = getattr(self.ya_api, '%s_%s' % ('resume', service))(resume_params, client_login=self.account.login)
-            assert len(ids) == len(resume_params["SelectionCriteria"]['Ids'])
+        errors = []
+        for method, state in (('suspend', 'SUSPENDED'), ('resume', 'ON')):
+            ids = [o.id for o in objs if o.state == state]
+            if ids:
+                # Отправляем запрос в Директ
+                results = self.select_ids_call(getattr(self.ya_api, '%s_%s' % (method, service)), service, ids)
+                errors += self._log_errors(method, obj_names, ids, results)
+        return errors
 
     def delete_objects(self, obj_names, ids):
+        """
+        :return: идентификаторы объектов, которые удалены в директе
+        """
         if not ids:
-            return
-        params = {"SelectionCriteria": {'Ids': ids}}
-        res_ids = getattr(self.ya_api, '%s_%s' % ('delete', obj_names.lower()))(params, client_login=self.account.login)
-        assert len(ids) == len(res_ids)
+            return []
+        service = obj_names.lower()
+        results = self.select_ids_call(getattr(self.ya_api, '%s_%s' % ('delete', service)), service, ids)
+        self._log_errors('delete', obj_names, ids, results)
+        return [id for id, result in zip(ids, results) if result_id(result) is not None]
 
-    def send_changes(self):
+    def dispatch_items(self, method, obj_names, items):
+        """
+        Отправляет объекты в метод апи add/update пачками, которые допускает директ. Пачки отправляются параллельно.
+        Ошибка в одной пачке не останавливает отправку остальных
+        :param method: метод ya_api
+        :param obj_names: название списка объектов в параметрах запроса (Campaigns, AdGroups, Ads, Keywords)
+        :param items: сериализованные объекты
+        :return: список результатов по одному на объект в порядке items. Для пачек с ошибкой - исключение
+        """
+        def call(chunk):
+            try:
+                return check_result_count(method({obj_names: chunk}, client_login=self.account.login), chunk)
+            except Exception as e:
+                logging.exception("%s request failed for %s" % (obj_names, self.account.login))
+                return [e] * len(chunk)
+
+        results = []
+        for chunk_results in self.map_chunks(call, items, self.write_limits.get(obj_names.lower(), 1000)):
+            results.extend(chunk_results)
+        return results
+
+    def _log_errors(self, action, obj_names, objs, results):
+        # возвращает и пишет в лог объекты, которые не удалось обработать
+        failed = [(obj, result) for obj, result in zip(objs, results) if result_id(result) is None]
+        if failed:
+            logging.error("%s %s: %d of %d failed for %s: %s" % (
+                action, obj_names, len(failed), len(results), self.account.login, failed))
+        return failed
+
+    def send_changes(self, workers=1):
         # отправляем локальные изменения в базу для всех аккаунтов
-        for account in Account.objects.exclude(disable=True).all():
-            logging.info("Send yandex data for %s" % account.login)
-            self.send_account_changes(account)
+        return self.for_each_account('send_account_changes', workers, "Send yandex data for %s")
 
     def send_account_changes(self, account):
         """отправляем изменения из локальной базы в директ"""
@@ -552,48 +890,69 @@ class DirectAPI(metaclass=Singleton):
             other_changed = updated
         # для остальных делим на стейт и остальные изменения
         else:
+            # получаем изменения после синхронизации для всех объектов сразу
+            changes = changed_fields_since(cls, [obj.id for obj in updated], sync_time)
             for obj in updated:
-                # получаем изменения после синхронизации
-                last_histories = obj.history.filter(history_date__gt=sync_time).all()
-                # сравниваем последнюю версию с объектом до начала изменений
-                delta = last_histories.last().diff_against(last_histories[0].prev_record)
+                changed_fields = changes.get(obj.id, set())
                 # проверяем измененные поля
-                if 'state' in delta.changed_fields:  # если изменилось поле стейт
+                if 'state' in changed_fields:  # если изменилось поле стейт
                     state_changed.append(obj)
-                if set(delta.changed_fields) - {'state'}:  # если изменились другие поля изи вложенные объекты
+                if changed_fields - {'state'}:  # если изменились другие поля изи вложенные объекты
                     other_changed.add(obj)
 
         other_changed.update(child_updated)
 
         # получаем идентификаторы удаленных объектов
         delete_objects = cls.objects.filter(q_filter, history__history_date__gt=sync_time, state='DELETE')
-        deleted_ids = list(delete_objects.values_list('id', flat=True))
+        deleted_ids = list(delete_objects.values_list('id', flat=True).distinct())
 
+        # объекты, которые не удалось создать, остаются с отрицательными id и будут отправлены в следующий раз
         self.add_objects(obj_names, new)
-        cls.objects.filter(q_filter, id__lt=0).delete()  # удаляем объекты со старыми идентификаторами
         self.update_objects(obj_names, list(other_changed))
         self.change_object_states(obj_names, state_changed)
         if before_delete:
             before_delete()
-        self.delete_objects(obj_names, deleted_ids)
-        delete_objects.delete()  # удаляем объекты из базы
+        deleted_ids = self.delete_objects(obj_names, deleted_ids)
+        cls.objects.filter(id__in=deleted_ids).delete()  # удаляем из базы объекты, которые удалены в директе
 
-    def modrate_new_ads(self):
+    def modrate_new_ads(self, batch_size=900):
         """
         Получаем из базы идентификаторы всех объевляений в статусе черновик и отправляем на модерацию
+        :param batch_size: количество идентификаторов в одном запросе к базе
         :return:
         """
         ids = list(TextAd.objects.filter(status='DRAFT', ad_group__campaign__account=self.account).values_list('id',
                                                                                                                flat=True))
         if not ids:
             return
-        params = {'SelectionCriteria': {'Ids': ids}}
-        mod_ids = self.ya_api.moderate_ads(params, client_login=self.account.login)
-        assert len(mod_ids) == len(ids)
+        results = self.select_ids_call(self.ya_api.moderate_ads, 'ads', ids)
+        self._log_errors('moderate', 'Ads', ids, results)
         # обновляем статус
-        for ad in TextAd.objects.filter(id__in=ids).all():
-            ad.status = 'MODERATION'
-            ad.save()
+        mod_ids = [id for id, result in zip(ids, results) if result_id(result) is not None]
+        for i in range(0, len(mod_ids), batch_size):
+            TextAd.objects.update_with_history(TextAd.objects.filter(id__in=mod_ids[i:i + batch_size]),
+                                               status='MODERATION')
+
+    def select_ids_call(self, method, service, ids):
+        """
+        Вызывает метод апи, который принимает SelectionCriteria с идентификаторами. Если идентификаторов больше, чем
+        допускает директ, отправляет их несколькими параллельными запросами
+        :param method: метод ya_api
+        :param service: название сервиса, для определения лимита
+        :return: результаты по одному на идентификатор. Для запросов с ошибкой - исключение
+        """
+        def call(chunk):
+            try:
+                return check_result_count(method({'SelectionCriteria': {'Ids': chunk}},
+                                                 client_login=self.account.login), chunk)
+            except Exception as e:
+                logging.exception("%s request failed for %s" % (service, self.account.login))
+                return [e] * len(chunk)
+
+        results = []
+        for chunk_results in self.map_chunks(call, ids, self.selection_ids_limits.get(service, 1000)):
+            results.extend(chunk_results)
+        return results
 
     def __getattr__(self, method_name):
         """
@@ -602,65 +961,60 @@ class DirectAPI(metaclass=Singleton):
         :param method_name:
         :return:
         """
-        # соответствие метода статусу
-        status_map={
+        # соответствие метода стейту
+        state_map={
             'archive':'ARCHIVED',
             'unarchive':'SUSPENDED',
-            'suspend':'ARCHIVED',
+            'suspend':'SUSPENDED',
             'resume':'ON',
         }
         def f(objects, *args, **kwarks):
             if not objects:
                 return
-            method = method_name.split('_', 1)[0]
+            method, service = method_name.split('_', 1)
             ids = [obj.id for obj in objects]
-            params = {'SelectionCriteria': {'Ids': ids}}
-            result_ids = getattr(self.ya_api,method_name)(params, client_login=self.account.login)
-            assert len(result_ids) == len(ids)
+            results = self.select_ids_call(getattr(self.ya_api, method_name), service, ids)
+            self._log_errors(method, service, ids, results)
+            changed_ids = [id for id, result in zip(ids, results) if result_id(result) is not None]
             cls = objects[0].__class__
-
-            for obj in cls.objects.filter(id__in=ids).all():
-                obj.status = status_map[method]
-                obj.save()
+            for i in range(0, len(changed_ids), 900):
+                queryset = cls.objects.filter(id__in=changed_ids[i:i + 900])
+                # история есть не у всех моделей, например у кампаний, которые не TextCampaign
+                if isinstance(cls.objects, BulkHistoryManager):
+                    cls.objects.update_with_history(queryset, state=state_map[method])
+                else:
+                    queryset.update(state=state_map[method])
 
         return f
 
 
-def change_id(obj, new_pk):
+class ResultCountError(Exception):
     """
-    Создает объект с новым идентификатором и привязывает к нему все объекты, которые были связаны с объектом obj.
-    Не удаляет объект со старым идентификатором.
-    !!!Это надо сделать вручную!!!!
-    :param obj:
-    :param new_pk:
-    :return:
+    Директ вернул не столько результатов, сколько объектов было отправлено. Результаты нельзя сопоставить с объектами
     """
-    # получаем названее полей, которые указывают на связанные объекты
-    # получаем объекты
-    related_objects = {}
-    one_to_one_objects = {}
-    for field in obj._meta.get_fields():
-        # если обратная связь один к одному. Если объект существует то вернет один объект, иначе вызовет исключение.
-        if issubclass(type(field), OneToOneRel):
-            field_name = field.get_accessor_name()
-            try:
-                one_to_one_objects[field_name] = getattr(obj, field_name)
-            except ObjectDoesNotExist:
-                continue
-        # для остальных связанных полей собираем список объектов
-        elif issubclass(type(field), ForeignObjectRel):
-            field_name = field.get_accessor_name()
-            related_objects[field_name] = getattr(obj, field_name).all()
-
-    # сохраняем новый объект, надо обновить и pk и id, т.к. при при multitable inheritance это разные значения. Будут пробемы если pk не id
-    obj.id = new_pk
-    obj.pk = new_pk
-    obj.save()
-    # обновляем id у связанных объектов
-    for field_name, objects in related_objects.items():
-        getattr(obj, field_name).set(objects)
-
-    for field_name, object in one_to_one_objects.items():
-        setattr(obj, field_name, object)
-        object.save()  # из-за связи 1 к 1 сохранять надо объект, в котором хранится связанный id
-    obj.save()
+
+
+def check_result_count(results, items):
+    """
+    Проверяет, что результатов столько же, сколько отправлено объектов, иначе результаты нельзя сопоставить по порядку
+    :return: results
+    """
+    if len(results) != len(items):
+        raise ResultCountError('%d results for %d items' % (len(results), len(items)))
+    return results
+
+
+def result_id(result):
+    """
+    Идентификатор объекта из результата операции директа
+    :param result: id, словарь вида {'Id': id}, {'KeywordId': id} или {'Errors': [...]}, либо исключение, если запрос не выполнен
+    :return: id или None, если операция завершилась ошибкой
+    """
+    if isinstance(result, Exception):
+        return None
+    if isinstance(result, dict):
+        if result.get('Errors'):
+            return None
+        # для ставок в результате KeywordId
+        return result.get('Id', result.get('KeywordId'))
+    return result
@@ -0,0 +1,166 @@
+"""
+Асинхронный клиент апи директа на aiohttp. Методы называются так же, как в yandex_direct_api.Api: '<метод>_<сервис>',
+например get_keywords, check_changes, set_keywordbids, и возвращают те же данные.
+Все запросы используют одну сессию с пулом соединений, поэтому в одном процессе можно держать сотни запросов одновременно.
+SyncTransport позволяет использовать клиент из синхронного кода (DirectAPI, management команды).
+"""
+import asyncio
+import csv
+import io
+import threading
+
+import aiohttp
+
+API_URL = 'https://api.direct.yandex.com/json/v5/'
+SANDBOX_API_URL = 'https://api-sandbox.direct.yandex.com/json/v5/'
+
+# методы, которые возвращают результат целиком, а не список объектов
+RAW_RESULT_METHODS = {'check', 'checkCampaigns', 'checkDictionaries'}
+
+
+class DirectAPIError(Exception):
+    """
+    Ошибка, которую вернул директ
+    """
+
+    def __init__(self, error_code, error_string, error_detail=''):
+        self.error_code = int(error_code)
+        self.error_string = error_string
+        self.error_detail = error_detail
+        super().__init__('Error %s: %s. %s' % (error_code, error_string, error_detail))
+
+
+class AsyncDirectTransport:
+    """
+    :param accounts: {login: token}. Запросы без client_login выполняются с токеном первого аккаунта
+    :param max_connections: максимальное количество одновременных соединений
+    :param report_retry_limit: сколько раз проверять готовность отчета
+    """
+
+    def __init__(self, accounts, sandbox=False, max_connections=200, report_retry_limit=100):
+        self.accounts = accounts
+        self.sandbox = sandbox
+        self.url = SANDBOX_API_URL if sandbox else API_URL
+        self.max_connections = max_connections
+        self.report_retry_limit = report_retry_limit
+        self.units = {}  # {login: заголовок Units последнего ответа}
+        self._session = None
+
+    async def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _headers(self, client_login):
+        login = client_login or next(iter(self.accounts))
+        headers = {'Authorization': 'Bearer %s' % self.accounts[login],
+                   'Accept-Language': 'ru'}
+        if client_login:
+            headers['Client-Login'] = client_login
+        return headers
+
+    def __getattr__(self, name):
+        if name.startswith('_') or '_' not in name:
+            raise AttributeError(name)
+        method, service = name.split('_', 1)
+
+        async def call(params=None, client_login=None):
+            return await self.call(service, method, params or {}, client_login)
+
+        return call
+
+    async def call(self, service, method, params, client_login=None):
+        """
+        Выполняет метод сервиса директа
+        :return: для get - список объектов, для add/update/delete и т.п. - список результатов по объектам,
+        для changes - результат целиком
+        """
+        session = await self.session()
+        async with session.post(self.url + service, json={'method': method, 'params': params},
+                                headers=self._headers(client_login)) as response:
+            if 'Units' in response.headers and client_login:
+                self.units[client_login] = response.headers['Units']
+            data = await response.json(content_type=None)
+        if 'error' in data:
+            error = data['error']
+            raise DirectAPIError(error['error_code'], error.get('error_string', ''), error.get('error_detail', ''))
+        result = data['result']
+        if method in RAW_RESULT_METHODS:
+            return result
+        result.pop('LimitedBy', None)
+        # в результате один список: объекты для get или результаты операций для остальных методов
+        return next(iter(result.values()), [])
+
+    async def reports(self, params, client_login=None):
+        """
+        Запрашивает отчет в формате TSV. Если директ формирует отчет в офлайне, ждет его готовности
+        :return: список строк отчета {поле: значение}
+        """
+        text = await self.report_text(params, client_login)
+        return list(csv.DictReader(io.StringIO(text), delimiter='\t'))
+
+    async def report_text(self, params, client_login=None):
+        session = await self.session()
+        headers = dict(self._headers(client_login), processingMode='auto', skipReportHeader='true',
+                       skipReportSummary='true', returnMoneyInMicros='false')
+        for _ in range(self.report_retry_limit):
+            async with session.post(self.url + 'reports', json={'params': params}, headers=headers) as response:
+                if response.status == 200:
+                    return await response.text()
+                if response.status in (201, 202):
+                    # отчет формируется, ждем время, которое рекомендует директ
+                    await asyncio.sleep(int(response.headers.get('retryIn', 10)))
+                    continue
+                data = await response.json(content_type=None)
+            error = data.get('error', {})
+            raise DirectAPIError(error.get('error_code', response.status), error.get('error_string', ''),
+                                 error.get('error_detail', ''))
+        raise DirectAPIError(0, 'Report is not ready', params.get('ReportName', ''))
+
+
+class SyncTransport:
+    """
+    Синхронная обертка над AsyncDirectTransport. Запросы выполняются в цикле событий отдельного потока,
+    поэтому запросы из разных потоков используют общую сессию и выполняются одновременно
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def sandbox(self):
+        return self.transport.sandbox
+
+    @property
+    def units(self):
+        return self.transport.units
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def __getattr__(self, name):
+        method = getattr(self.transport, name)
+
+        def call(*args, **kwargs):
+            return self.run(method(*args, **kwargs))
+
+        return call
+
+    def close(self):
+        """
+        Закрывает сессию и останавливает цикл событий. После этого запросы выполнять нельзя
+        """
+        if self._loop.is_closed():
+            return
+        self.run(self.transport.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
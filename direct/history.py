@@ -0,0 +1,84 @@
+"""
+Обслуживание истории объектов директа (simple_history).
+История нужна для отправки изменений: send_objects_of_class ищет записи истории после sync_time аккаунта и сравнивает
+последнюю версию объекта с версией до sync_time (changed_fields_since). Более старые записи не нужны, поэтому для
+каждого объекта из них остается одна - последняя до sync_time, остальные удаляются.
+"""
+import logging
+
+from django.db import transaction
+from django.db.models import Max
+from simple_history.utils import get_history_model_for_model
+
+from direct.models import Account, TextCampaign, AdGroup, GroupNegativeKeyword, Keyword, TextAd
+
+# модели с историей и путь от модели к аккаунту
+HISTORY_MODELS = (
+    (TextCampaign, 'account'),
+    (AdGroup, 'campaign__account'),
+    (GroupNegativeKeyword, 'ad_group__campaign__account'),
+    (TextAd, 'ad_group__campaign__account'),
+    (Keyword, 'ad_group__campaign__account'),
+)
+
+
+def prune_history(before=None):
+    """
+    Удаляет записи истории, которые не нужны для отправки изменений. Для объектов каждого аккаунта из записей до
+    sync_time аккаунта остается только последняя. История удаленных объектов удаляется до самого раннего sync_time.
+    Аккаунты без sync_time не обрабатываются, т.к. у них не отправлено ничего
+    :param before: удалять только записи раньше этого времени, например что бы хранить историю для просмотра
+    :return: {модель: количество удаленных записей}
+    """
+    accounts = list(Account.objects.filter(sync_time__isnull=False))
+    if not accounts:
+        return {}
+    deleted = {}
+    for model, account_path in HISTORY_MODELS:
+        history_model = get_history_model_for_model(model)
+        count = 0
+        with transaction.atomic():
+            for account in accounts:
+                cutoff = min(account.sync_time, before) if before else account.sync_time
+                count += _collapse(history_model, model.objects.filter(**{account_path: account}).values('id'),
+                                   cutoff)
+            # история объектов, которых уже нет в базе
+            cutoff = min(account.sync_time for account in accounts)
+            cutoff = min(cutoff, before) if before else cutoff
+            count += history_model.objects.filter(history_date__lte=cutoff).exclude(
+                id__in=model._base_manager.values('id')).delete()[0]
+        logging.info('%s history pruned: %s rows' % (model.__name__, count))
+        deleted[model] = count
+    return deleted
+
+
+def _collapse(history_model, ids, cutoff):
+    """
+    Оставляет у объектов ids одну запись истории до cutoff - последнюю
+    :return: количество удаленных записей
+    """
+    old = history_model.objects.filter(id__in=ids, history_date__lte=cutoff)
+    last_ids = old.values('id').annotate(last_history_id=Max('history_id')).values('last_history_id')
+    return old.exclude(history_id__in=last_ids).delete()[0]
+
+
+def history_index_name(history_model):
+    return '%s_id_date' % history_model._meta.db_table
+
+
+def create_history_indexes(connection, history_models):
+    """
+    Создает индексы (id, history_date) для запросов истории объекта после sync_time. Используется в миграции
+    """
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for history_model in history_models:
+            cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s (id, history_date)' % (
+                qn(history_index_name(history_model)), qn(history_model._meta.db_table)))
+
+
+def drop_history_indexes(connection, history_models):
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for history_model in history_models:
+            cursor.execute('DROP INDEX IF EXISTS %s' % qn(history_index_name(history_model)))
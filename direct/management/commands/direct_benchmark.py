@@ -0,0 +1,40 @@
+import copy
+import time
+
+from django.core.management.base import BaseCommand
+
+from direct.models import Keyword, TextAd, DirectStats
+
+# строки в том виде, в котором их возвращает директ
+SAMPLE_ROWS = {
+    Keyword: {'Id': 1, 'Keyword': 'купить слона', 'State': 'ON', 'Status': 'ACCEPTED', 'ServingStatus': 'ELIGIBLE',
+              'AdGroupId': 1, 'Bid': 10_000_000, 'ContextBid': 0, 'StrategyPriority': None, 'UserParam1': None,
+              'UserParam2': None},
+    TextAd: {'Id': 1, 'AdGroupId': 1, 'State': 'ON', 'Status': 'ACCEPTED', 'StatusClarification': None,
+             'TextAd': {'AdImageHash': None, 'DisplayDomain': 'ya.ru', 'Href': 'https://ya.ru', 'Text': 'text',
+                        'Title': 'title', 'Title2': None, 'Mobile': 'NO', 'VCardId': None, 'DisplayUrlPath': None}},
+    DirectStats: {'Date': '2020-12-01', 'CampaignId': '1', 'AdGroupId': '1', 'AdId': '1', 'CriterionId': '1',
+                  'Clicks': '3', 'Impressions': '100', 'Device': 'DESKTOP', 'TargetingLocationId': '213',
+                  'Gender': 'GENDER_MALE', 'Age': 'AGE_25_34', 'CarrierType': 'UNKNOWN', 'MobilePlatform': 'UNKNOWN',
+                  'Slot': 'OTHER'},
+}
+
+
+class Command(BaseCommand):
+    help = 'Замеряет скорость десериализации ответов директа (строк в секунду)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20000, help='Количество строк для каждой модели')
+        parser.add_argument('--no-cache', action='store_true',
+                            help='Сбрасывать таблицу полей перед каждой строкой, как до ее появления')
+
+    def handle(self, *args, **options):
+        for cls, sample in SAMPLE_ROWS.items():
+            rows = [copy.deepcopy(sample) for _ in range(options['rows'])]
+            start = time.perf_counter()
+            for row in rows:
+                if options['no_cache']:
+                    cls._api_fields = {}
+                cls.deserialize(row)
+            elapsed = time.perf_counter() - start
+            self.stdout.write('%s: %d rows/sec' % (cls.__name__, len(rows) / elapsed))
@@ -0,0 +1,21 @@
+import logging
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from direct.history import prune_history
+
+
+class Command(BaseCommand):
+    help = 'Удаляет историю объектов директа, которая не нужна для отправки изменений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-days', type=int, help='Сколько дней хранить всю историю')
+
+    def handle(self, *args, **options):
+        before = None
+        if options['keep_days'] is not None:
+            before = timezone.now() - timedelta(days=options['keep_days'])
+        deleted = prune_history(before)
+        logging.info('Direct history pruned: %s rows' % sum(deleted.values()))
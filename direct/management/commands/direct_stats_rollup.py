@@ -0,0 +1,17 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from direct.retention import rollup_stats
+
+
+class Command(BaseCommand):
+    help = 'Сворачивает старую статистику директа по дням и неделям'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--detail-days', type=int, help='Сколько дней хранить детальную статистику')
+        parser.add_argument('--daily-days', type=int, help='Сколько дней хранить статистику по дням')
+
+    def handle(self, *args, **options):
+        detail_from, daily_from = rollup_stats(options['detail_days'], options['daily_days'])
+        logging.info('Direct stats rolled up: detail from %s, daily from %s' % (detail_from, daily_from))
@@ -1,6 +1,6 @@
 from collections import OrderedDict
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from direct.api_manager import *
 
@@ -8,7 +8,24 @@ from direct.api_manager import *
 class Command(BaseCommand):
     help = 'Загружает статистику действий в admitad'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Сколько аккаунтов загружать одновременно')
+        parser.add_argument('--request-workers', type=int, default=DirectAPI.request_workers,
+                            help='Сколько запросов к апи одновременно отправлять для одного аккаунта')
+        parser.add_argument('--aiohttp', action='store_true',
+                            help='Отправлять запросы через асинхронный клиент с общим пулом соединений')
+        parser.add_argument('--report-queue', action='store_true',
+                            help='Запрашивать отчеты всех аккаунтов одновременно после загрузки объектов')
+
     def handle(self, *args, **options):
         accs = OrderedDict([(acc.login, acc.auth_token) for acc in Account.objects.exclude(disable=True).all()])
-        api = DirectAPI(accounts = accs)
-        api.load_data()
+        api = DirectAPI(accounts = accs, use_aiohttp=options['aiohttp'])
+        api.request_workers = options['request_workers']
+        try:
+            errors = api.load_data(workers=options['workers'], report_queue=options['report_queue'])
+        finally:
+            # закрываем сессию aiohttp и цикл событий
+            api.close()
+        if errors:
+            raise CommandError('Yandex sync failed for %s' % ', '.join(errors))
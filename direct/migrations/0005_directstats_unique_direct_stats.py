@@ -0,0 +1,17 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('direct', '0004_directstats_shows'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='directstats',
+            constraint=models.UniqueConstraint(fields=('date', 'criterion', 'ad', 'region_id', 'device', 'gender', 'age', 'carrier_type', 'mobile_platform', 'slot'), name='unique_direct_stats'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:30
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+
+
+def fill_last_stats_date(apps, schema_editor):
+    Account = apps.get_model('direct', 'Account')
+    DirectStats = apps.get_model('direct', 'DirectStats')
+    last_date = DirectStats.objects.filter(campaign__account=OuterRef('pk')).values('campaign__account').annotate(
+        last_date=Max('date')).values('last_date')
+    Account.objects.update(last_stats_date=Subquery(last_date))
+
+
+def partition_stats(apps, schema_editor):
+    # секционирование поддерживается только в PostgreSQL
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    from direct.partitions import partition_table
+    partition_table(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('direct', '0005_directstats_unique_direct_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='last_stats_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_last_stats_date, migrations.RunPython.noop),
+        migrations.RunPython(partition_stats, migrations.RunPython.noop),
+    ]
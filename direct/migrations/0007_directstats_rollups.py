@@ -0,0 +1,47 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import joinfield.joinfield
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('direct', '0006_directstats_partitions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectStatsDaily',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('shows', models.IntegerField()),
+                ('clicks', models.IntegerField()),
+                ('campaign', joinfield.joinfield.JoinField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='direct.Campaign')),
+                ('criterion', joinfield.joinfield.JoinField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='direct.Criterion')),
+                ('group', joinfield.joinfield.JoinField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='direct.AdGroup')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DirectStatsWeekly',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('shows', models.IntegerField()),
+                ('clicks', models.IntegerField()),
+                ('campaign', joinfield.joinfield.JoinField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='direct.Campaign')),
+                ('criterion', joinfield.joinfield.JoinField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='direct.Criterion')),
+                ('group', joinfield.joinfield.JoinField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='direct.AdGroup')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='directstatsdaily',
+            constraint=models.UniqueConstraint(fields=('date', 'campaign', 'group', 'criterion'), name='unique_direct_stats_daily'),
+        ),
+        migrations.AddConstraint(
+            model_name='directstatsweekly',
+            constraint=models.UniqueConstraint(fields=('date', 'campaign', 'group', 'criterion'), name='unique_direct_stats_weekly'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.0.3 on 2026-10-18 14:00
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def fill_dictionaries(apps, schema_editor):
+    # общая метка - самая ранняя из меток аккаунтов, что бы не пропустить изменения
+    Account = apps.get_model('direct', 'Account')
+    Dictionary = apps.get_model('direct', 'Dictionary')
+    last_changes_time = Account.objects.aggregate(time=Min('last_dictionaries_changes_time'))['time']
+    if last_changes_time:
+        Dictionary.objects.create(name='GeoRegions', last_changes_time=last_changes_time)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('direct', '0007_directstats_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Dictionary',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('last_changes_time', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(fill_dictionaries, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='account',
+            name='last_dictionaries_changes_time',
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.0.3 on 2026-10-18 14:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_region_tree(apps, schema_editor):
+    from direct.models import region_tree_rows
+    Region = apps.get_model('direct', 'Region')
+    RegionTree = apps.get_model('direct', 'RegionTree')
+    parents = dict(Region.objects.values_list('id', 'parent_id'))
+    RegionTree.objects.bulk_create([RegionTree(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth)
+                                    for ancestor_id, descendant_id, depth in region_tree_rows(parents)],
+                                   batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('direct', '0008_dictionary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegionTree',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='direct.Region')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='direct.Region')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='regiontree',
+            constraint=models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_region_tree'),
+        ),
+        migrations.RunPython(fill_region_tree, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.3 on 2026-10-18 15:00
+
+from django.db import migrations
+
+HISTORY_MODELS = ['HistoricalTextCampaign', 'HistoricalAdGroup', 'HistoricalGroupNegativeKeyword',
+                  'HistoricalTextAd', 'HistoricalKeyword']
+
+
+def create_indexes(apps, schema_editor):
+    from direct.history import create_history_indexes
+    create_history_indexes(schema_editor.connection, [apps.get_model('direct', name) for name in HISTORY_MODELS])
+
+
+def drop_indexes(apps, schema_editor):
+    from direct.history import drop_history_indexes
+    drop_history_indexes(schema_editor.connection, [apps.get_model('direct', name) for name in HISTORY_MODELS])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('direct', '0009_regiontree'),
+    ]
+
+    operations = [
+        # индексы создаются SQL, т.к. модели истории создает simple_history и в них нельзя добавить Meta.indexes
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -4,58 +4,140 @@
 !!!!!
 Объекты, которые есть в базе, но нет в директе создаются с отрицательными идентификаторвами. После создания в директе эти объекты удаляются, создаются их копии с реальными идентификаторами. В связанных записях идентификаторы обновляются.
 """
+import contextlib
+import copy
 import functools
+import hashlib
+import io
+import itertools
 import operator
+import threading
+import time
 from collections import OrderedDict
 from datetime import date, timedelta
 
 import inflection as inflection
 from bulk_sync import bulk_sync
-from django.db import models, transaction
-from django.db.models import CASCADE, ManyToOneRel, ManyToManyRel, Sum, Q, ForeignObject, ManyToManyField
+from django.core.cache import caches
+from django.db import models, transaction, connections, router
+from django.db.models import CASCADE, ManyToOneRel, ManyToManyRel, Sum, Q, ForeignObject, ManyToManyField, Max, Case, \
+    When, Value, F, SET_NULL, DO_NOTHING, ProtectedError
 from django.db.models.fields.related import RelatedField
 from django.db.models.fields.reverse_related import ForeignObjectRel
 from django.db.models.functions import Coalesce
 from django.forms import model_to_dict
+from django.utils import timezone
 from django.utils.functional import cached_property
 from joinfield.joinfield import JoinField
 from simple_history.models import HistoricalRecords
-from simple_history.utils import bulk_create_with_history, bulk_update_with_history
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history, get_history_model_for_model, \
+    get_history_manager_for_model
 
 from ads_manager.models import AdTemplate
 
 INT_TYPES = {'IntegerField', 'BigIntegerField', 'AutoField', 'BigAutoField'}
+TEXT_TYPES = {'CharField', 'TextField', 'URLField'}
+
+
+def to_int(value):
+    # если не None, приводим строку к целому
+    return value if value is None else int(value)
+
+
+def to_text(value):
+    # Для текстовых полей None это ''
+    return '' if value is None else value
+
+
+# вызовы bulk_*_with_history, которые выполняются в текущем потоке {(модель, метод)}.
+# Менеджер один на все потоки, поэтому флаг рекурсии хранится не в нем
+_history_calls = threading.local()
 
 
 class BulkHistoryManager(models.Manager):
-    def bulk_create(self, objs, *args, **kwargs):
-        # django не поддерживает bulk_create для моделей с multitabel inheritance. В этом случае просто сохраняем каждый объект.
-        if is_multitabel_inheritance(self.model):
-            # todo: очень тормознутое место. Адаптировать bulk_create для multitabel, что бы ускорить
-            with transaction.atomic():
-                for obj in objs:
-                    obj.save()
-            return objs
+    def _in_history_call(self, method):
+        return (self.model, method) in getattr(_history_calls, 'active', set())
+
+    @contextlib.contextmanager
+    def _history_call(self, method):
+        if not hasattr(_history_calls, 'active'):
+            _history_calls.active = set()
+        key = (self.model, method)
+        _history_calls.active.add(key)
+        try:
+            yield
+        finally:
+            _history_calls.active.discard(key)
 
-        # Что бы не остановить бесконечную рекурсию, добавляем флаг при первом вызове
-        if hasattr(self, '_bulk_create_recursion'):
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create_with_history вызывает bulk_create модели, что бы не было бесконечной рекурсии, отмечаем вызов
+        if self._in_history_call('bulk_create'):
+            # django не поддерживает bulk_create для моделей с multitabel inheritance, для них своя реализация
+            if is_multitabel_inheritance(self.model):
+                return self._bulk_create_multitable(objs, *args, **kwargs)
             return super().bulk_create(objs, *args, **kwargs)
-        else:
-            self._bulk_create_recursion = True
-            res = bulk_create_with_history(objs, self.model, *args, **kwargs)
-            del self._bulk_create_recursion
-            return res
+        with self._history_call('bulk_create'):
+            return bulk_create_with_history(objs, self.model, *args, **kwargs)
+
+    def _bulk_create_multitable(self, objs, batch_size=None, ignore_conflicts=False):
+        """
+        bulk_create для моделей с multitable inheritance. Строки вставляются пачками отдельно в таблицу каждой модели
+        из цепочки наследования, начиная с самой верхней. Первичные ключи должны быть заданы (идентификаторы директа)
+        """
+        objs = list(objs)
+        if not objs:
+            return objs
+        # цепочка наследования от корневой модели к текущей
+        models_chain = list(reversed(self.model._meta.get_parent_list())) + [self.model]
+        root_pk = models_chain[0]._meta.pk.attname
+        for obj in objs:
+            pk = getattr(obj, root_pk)
+            if pk is None:
+                raise ValueError("Can't bulk create multi-table inherited objects without primary key")
+            # ссылки на родительские объекты совпадают с первичным ключом корневой модели
+            for model in models_chain:
+                for parent_link in model._meta.parents.values():
+                    if parent_link:
+                        setattr(obj, parent_link.attname, pk)
+
+        with transaction.atomic(using=self.db, savepoint=False):
+            for model in models_chain:
+                model._base_manager.using(self.db)._batched_insert(objs, model._meta.local_concrete_fields, batch_size,
+                                                                   ignore_conflicts=ignore_conflicts)
+        for obj in objs:
+            obj._state.adding = False
+            obj._state.db = self.db
+        return objs
 
     def bulk_update(self, objs, *args, **kwargs):
-        if hasattr(self, '_bulk_update_recursion'):
+        if self._in_history_call('bulk_update'):
             return super().bulk_update(objs, *args, **kwargs)
-        else:
-            self._bulk_update_recursion = True
-            res = bulk_update_with_history(objs, self.model, *args, **kwargs)
-            del self._bulk_update_recursion
-            return res
-
+        with self._history_call('bulk_update'):
+            return bulk_update_with_history(objs, self.model, *args, **kwargs)
 
+    def update_with_history(self, queryset, batch_size=900, **values):
+        """
+        Устанавливает одинаковые значения полей всем объектам queryset пачками UPDATE и пачкой записывает историю
+        :param batch_size: количество идентификаторов в одном UPDATE
+        :param values: {поле: значение}
+        :return: количество измененных объектов
+        """
+        with transaction.atomic(using=self.db, savepoint=False):
+            objs = list(queryset)
+            if not objs:
+                return 0
+            for obj in objs:
+                for field_name, value in values.items():
+                    setattr(obj, field_name, value)
+            pks = [obj.pk for obj in objs]
+            count = 0
+            for i in range(0, len(pks), batch_size):
+                count += self.filter(pk__in=pks[i:i + batch_size]).update(**values)
+            get_history_manager_for_model(self.model).bulk_history_create(objs, update=True)
+        return count
+
+
+@functools.lru_cache(maxsize=None)
 def is_multitabel_inheritance(cls):
     for parent in cls._meta.get_parent_list():
         if parent._meta.concrete_model is not cls._meta.concrete_model:
@@ -66,6 +148,39 @@ def is_multitabel_inheritance(cls):
 class APIParserMixing:
     exclude_serialize_fields = set()  # поля, которые не выводятся при сериализации
     exclude_serialize_update_fields = exclude_serialize_fields | set()  # дополнительные поля, которые исключаются при обновлении
+    serialize_names = {}  # названия полей в директе, которые не получаются из названия поля переводом в CamelCase
+    sync_batch_size = 1000  # сколько объектов ответа апи синхронизируется с базой за раз
+
+    @classmethod
+    def api_fields(cls):
+        """
+        Таблица преобразования ключей апи в поля модели {ключ: (attname, конвертер) или None, если такого поля нет}.
+        Своя для каждого класса, заполняется по мере появления новых ключей в ответах апи
+        """
+        if '_api_fields' not in cls.__dict__:
+            cls._api_fields = {}
+        return cls._api_fields
+
+    @classmethod
+    def compile_api_field(cls, key):
+        """
+        Находит поле модели для ключа апи и функцию преобразования значения
+        :return: (attname, конвертер) или None, если такого поля нет
+        """
+        # преобразуем CamelCase название в under_score
+        field_name = inflection.underscore(key)
+        # если такого поля нет, ничего не делаем
+        if field_name not in cls.field_names():
+            return None
+        field = cls._meta.get_field(field_name)
+        field_type = field.get_internal_type()
+        converter = None
+        if field_type in TEXT_TYPES:
+            converter = to_text
+        elif field_type in INT_TYPES or (field.is_relation and field.foreign_related_fields[
+            0].get_internal_type() in INT_TYPES):
+            converter = to_int
+        return field_name, converter
 
     @classmethod
     def api_data_to_kwargs(cls, data):
@@ -75,23 +190,16 @@ class APIParserMixing:
         :return: возвращает словарь {field:value,}
         """
         params = {}
-        fields = cls.field_names()
+        api_fields = cls.api_fields()
         for k, v in data.items():
-            # преобразуем CamelCase название в under_score
-            field_name = inflection.underscore(k)
-            # если такого поля нет, ничего не делаем
-            if field_name not in fields:
+            try:
+                api_field = api_fields[k]
+            except KeyError:
+                api_field = api_fields[k] = cls.compile_api_field(k)
+            if api_field is None:
                 continue
-            field = cls._meta.get_field(field_name)
-            field_type = field.get_internal_type()
-            # Для текстовых полей None это ''
-            if v is None and field_type in {'CharField', 'TextField', 'URLField'}:
-                v = ''
-            # если не None и у поля целое значение, приводим строку к целому
-            if v is not None and (field_type in INT_TYPES or (field.is_relation and field.foreign_related_fields[
-                0].get_internal_type() in INT_TYPES)):
-                v = int(v)
-            params[field_name] = v
+            field_name, converter = api_field
+            params[field_name] = converter(v) if converter else v
         return params
 
     @classmethod
@@ -117,45 +225,108 @@ class APIParserMixing:
         return params
 
     @classmethod
-    def sync_response(cls, api_results, filter):
+    def sync_response(cls, api_results, filter, skip_deletes=False, batch_size=None):
         """
         Обновляет и добавлет объекты, которые были получены по апи.
+        Объекты обрабатываются пачками по batch_size вместе с вложенными объектами, поэтому в памяти одновременно только
+        одна пачка. Все состояние синхронизации локальное, поэтому синхронизации в разных потоках не мешают друг другу
         :filter: Параметры фильтра - id объектов, которые были запрошены и тип id. Что бы удалять объекты, которые были запрошены но не были получены
-        :return:
+        :param api_results: список или итератор объектов, которые вернул апи
+        :param skip_deletes: не удалять объекты, которые запрошены, но не получены. Нужно, когда ответ получается по страницам.
+        Вложенные объекты при этом удаляются только у объектов из api_results
+        :param batch_size: размер пачки, по умолчанию sync_batch_size
+        :return: первичные ключи полученных объектов
         """
-        if not api_results:
-            return
+        api_results = iter(api_results)
+        batch_size = batch_size or cls.sync_batch_size
+        pks = []
+        while True:
+            batch = list(itertools.islice(api_results, batch_size))
+            if not batch:
+                break
+            pks.extend(cls._sync_batch(batch, filter))
+        # объекты, которые не получены, удаляются в конце, вместе с вложенными объектами
+        if not skip_deletes:
+            cls.delete_missing(filter, set(pks))
+        return pks
 
+    @classmethod
+    def _sync_batch(cls, api_results, filter):
+        """
+        Синхронизирует пачку объектов и их вложенные объекты без удаления объектов, которых нет в пачке
+        :return: первичные ключи объектов пачки
+        """
         # Собираем список классов с объектами, которые надо изменить и другими параметрами.
-        cls.modified_objects = OrderedDict()  # {class:{'objects':[objects], 'fields':[str]}}. OrderedDict, чтобы сначала создать родительские объекты, потом дочерние
+        # Список локальный, а не атрибут класса, что бы синхронизации в разных потоках не мешали друг другу
+        modified_objects = OrderedDict()  # {class:{'objects':[objects], 'fields':[str]}}. OrderedDict, чтобы сначала создать родительские объекты, потом дочерние
 
         # десериализируем объекты в ответе
+        deserialized = []
         for item in api_results:
             # получаем объект и поля, которые вернул директ
             obj, recieved_fields = cls.deserialize(item)
-            cls.modified_objects.setdefault(cls, {}).setdefault('objects', []).append(obj)
+            modified_objects.setdefault(cls, {}).setdefault('objects', []).append(obj)
+            deserialized.append((obj, item))
+
+        pks = [obj.pk for obj in modified_objects[cls]['objects']]
+        # bulk_sync загружает из базы все объекты под фильтром, поэтому фильтр ограничен объектами пачки.
+        # Вложенные объекты тоже синхронизируются только у объектов пачки
+        batch_filter = dict(filter, pk__in=pks)
+        modified_objects[cls]['fields'] = recieved_fields
+        modified_objects[cls]['key_fields'] = ['pk']
+        modified_objects[cls]['filter'] = batch_filter
+        modified_objects[cls]['skip_deletes'] = True
+
+        for obj, item in deserialized:
             # десериализируем вложенные объекты
-            cls.deserialize_nested(obj, item, filter)
-
-        cls.modified_objects[cls]['fields'] = recieved_fields
-        cls.modified_objects[cls]['key_fields'] = ['pk']
-        cls.modified_objects[cls]['filter'] = filter
+            cls.deserialize_nested(obj, item, batch_filter, modified_objects)
 
         # синхронизируем с базой (создаем, обновляем, удаляем)
-        for db_class, data in cls.modified_objects.items():
+        for db_class, data in modified_objects.items():
             bulk_sync(new_models=data['objects'],
                       key_fields=data['key_fields'],
                       filters=Q(**data['filter']),
                       fields=data['fields'],
+                      skip_deletes=data.get('skip_deletes', False),
+                      db_class=db_class,  # список объектов может быть пустым, тогда удаляются все объекты под фильтром
                       )
+        return pks
+
+    @classmethod
+    def sync_pages(cls, pages, filter):
+        """
+        Синхронизирует ответ апи, полученный по страницам. Каждая страница сохраняется в базу сразу после получения,
+        объекты, которые не были получены ни на одной странице, удаляются в конце
+        :param pages: итератор списков объектов, которые вернул апи
+        :param filter: см. sync_response
+        :return:
+        """
+        received_pks = set()
+        for page in pages:
+            received_pks.update(cls.sync_response(page, filter, skip_deletes=True))
+        cls.delete_missing(filter, received_pks)
+
+    @classmethod
+    def delete_missing(cls, filter, received_pks, batch_size=900):
+        """
+        Удаляет объекты, которые подходят под filter, но не были получены по апи.
+        Если не получено ни одного объекта, ничего не удаляет (как sync_response)
+        """
+        if not received_pks:
+            return
+        missing = [pk for pk in cls.objects.filter(**filter).values_list('pk', flat=True).iterator()
+                   if pk not in received_pks]
+        for i in range(0, len(missing), batch_size):
+            cls.objects.filter(pk__in=missing[i:i + batch_size]).delete()
 
     @classmethod
-    def deserialize_nested(cls, obj, item, filter):
+    def deserialize_nested(cls, obj, item, filter, modified_objects):
         """
         Отвечает за десериализацию вложенных объектов. Переопределяется в классах-потомках
         :param obj: родительский объект
         :param item: ответ сервера с одним объектом
         :param filter: фильтры, объектов, которые были запрошены
+        :param modified_objects: объекты текущей синхронизации, в которые добавляются вложенные объекты
         :return:
         """
         pass
@@ -165,23 +336,55 @@ class APIParserMixing:
         return {f.attname for f in cls._meta.get_fields() if
                 not isinstance(f, ManyToOneRel) and not isinstance(f, ManyToManyRel)}
 
-    def serialize(self, exclude=None, include_null=False):
+    @classmethod
+    def serialize_plan(cls, exclude=None):
+        """
+        Список полей для сериализации [(attname, CamelCaseName)]. Строится один раз для каждого класса и набора исключений
+        :param exclude: название полей, которые нужно исключить
+        """
+        key = frozenset(exclude or ())
+        if '_serialize_plans' not in cls.__dict__:
+            cls._serialize_plans = {}
+        try:
+            return cls._serialize_plans[key]
+        except KeyError:
+            pass
+        # получаем названия полей модели, исключая поля, один ко многим. То есть получаем поля которые, хранятся в таблице.
+        model_field_names = [field.attname for field in cls._meta.get_fields() if
+                             not issubclass(type(field), ForeignObjectRel)]
+        # переводим в CamelCase
+        plan = tuple((name, cls.serialize_names.get(name) or inflection.camelize(name))
+                     for name in model_field_names if name not in key)
+        cls._serialize_plans[key] = plan
+        return plan
+
+    def serialize(self, exclude=None, include_null=False, plan=None):
         """
         Переобразует модель базы данных в объект для отправки в директ
         :param exclude: название полей, которые нужно исключить
         :param include_null: выводить ли поля без значений
+        :param plan: заранее полученный serialize_plan, тогда exclude не используется
         :return:
         """
-        # получаем все поля
+        if plan is None:
+            plan = self.serialize_plan(exclude)
         d = self.__dict__
+        result = {}
+        for name, api_name in plan:
+            value = d[name] if name in d else getattr(self, name)
+            # удаляем поля с пустыми значениями
+            if include_null or value:
+                result[api_name] = value
+        return result
 
-        # получаем названия полей модели, исключая поля, один ко многим. То есть получаем поля которые, хранятся в таблице.
-        model_field_names = [field.attname for field in self._meta.get_fields() if
-                             not issubclass(type(field),
-                                            ForeignObjectRel)]  # not issubclass(type(field), RelatedField) and not issubclass(type(field), ForeignObject)]
-        # переводим в CamelCase, удаляем поля с пустыми значениями
-        return {inflection.camelize(name): getattr(self, name) for name in model_field_names if
-                not (exclude and name in exclude) and (include_null or getattr(self, name))}
+    @classmethod
+    def serialize_many(cls, objs, exclude=None, include_null=False):
+        """
+        Сериализует список объектов класса cls для отправки в директ. План сериализации получается один раз на весь список
+        :return: список сериализованных объектов
+        """
+        plan = cls.serialize_plan(exclude)
+        return [obj.serialize(include_null=include_null, plan=plan) for obj in objs]
 
 
 class Region(models.Model, APIParserMixing):
@@ -197,12 +400,130 @@ class Region(models.Model, APIParserMixing):
     parent = models.ForeignKey("self", on_delete=CASCADE, null=True, blank=True)  # родительский регион
     geo_region_type = models.CharField(max_length=20, choices=TYPE_CHOICES)
 
+    CACHE_FIELDS = ('geo_region_name', 'parent_id', 'geo_region_type')  # поля, по которым регионы сравниваются с кешем
+    _cache = None  # {id: регион}, регионы общие для всех аккаунтов и меняются редко
+    _cache_lock = threading.Lock()
+
     @classmethod
     def deserialize(cls, data):
         modified_data = data
         modified_data['id'] = data.pop('GeoRegionId')
         return super().deserialize(modified_data)
 
+    @classmethod
+    def cached(cls):
+        """
+        Регионы из памяти процесса. Из базы загружаются при первом обращении
+        :return: {id: регион}
+        """
+        with cls._cache_lock:
+            if cls._cache is None:
+                cls._cache = {region.id: region for region in cls.objects.all()}
+            return cls._cache
+
+    @classmethod
+    def sync_cached(cls, api_results, batch_size=900):
+        """
+        Синхронизирует справочник регионов. Полученные регионы сравниваются с кешем, в базу записываются только
+        изменения, кеш заменяется полученными регионами
+        :return: изменились ли регионы
+        """
+        if not api_results:
+            return False
+        cached = cls.cached()
+        regions = {}
+        for item in api_results:
+            region, fields = cls.deserialize(item)
+            regions[region.id] = region
+        key = operator.attrgetter(*cls.CACHE_FIELDS)
+        new = [r for id, r in regions.items() if id not in cached]
+        changed = [r for id, r in regions.items() if id in cached and key(r) != key(cached[id])]
+        deleted = [id for id in cached if id not in regions]
+        with transaction.atomic():
+            cls.objects.bulk_create(new, batch_size=batch_size)
+            cls.objects.bulk_update(changed, ['geo_region_name', 'parent', 'geo_region_type'], batch_size=batch_size)
+            for i in range(0, len(deleted), batch_size):
+                cls.objects.filter(id__in=deleted[i:i + batch_size]).delete()
+        with cls._cache_lock:
+            cls._cache = regions
+        return bool(new or changed or deleted)
+
+    @classmethod
+    def rebuild_tree(cls):
+        """
+        Пересчитывает иерархию регионов (RegionTree) по кешу регионов
+        """
+        parents = {id: region.parent_id for id, region in cls.cached().items()}
+        with transaction.atomic():
+            RegionTree.objects.all().delete()
+            fast_bulk_insert(RegionTree, [RegionTree(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth)
+                                          for ancestor_id, descendant_id, depth in region_tree_rows(parents)])
+
+    @classmethod
+    def descendant_ids(cls, *region_ids, include_self=True):
+        """
+        Идентификаторы регионов, которые входят в region_ids. Запрос выполняется по индексу иерархии, результат можно
+        использовать в фильтрах, например DirectStats.objects.filter(region_id__in=Region.descendant_ids(1))
+        :param include_self: включать ли сами region_ids
+        :return: queryset идентификаторов
+        """
+        tree = RegionTree.objects.filter(ancestor_id__in=region_ids)
+        if not include_self:
+            tree = tree.filter(depth__gt=0)
+        return tree.values_list('descendant_id', flat=True)
+
+    def descendants(self):
+        # все регионы, которые входят в этот регион, на любом уровне
+        return Region.objects.filter(id__in=self.descendant_ids(self.id, include_self=False))
+
+    def ancestors(self):
+        # все регионы, в которые входит этот регион, от ближайшего к миру
+        return Region.objects.filter(descendant_links__descendant=self, descendant_links__depth__gt=0).order_by(
+            'descendant_links__depth')
+
+
+class RegionTree(models.Model):
+    """
+    Иерархия регионов (closure table): для каждого региона строки со всеми его предками, включая сам регион с
+    глубиной 0. Пересчитывается при синхронизации справочника регионов
+    """
+    ancestor = models.ForeignKey(Region, on_delete=CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Region, on_delete=CASCADE, related_name='ancestor_links')
+    depth = models.IntegerField()  # сколько уровней между регионами
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='unique_region_tree')
+        ]
+
+
+def region_tree_rows(parents):
+    """
+    Строки иерархии регионов
+    :param parents: {id региона: id родителя}
+    :return: список (id предка, id потомка, глубина)
+    """
+    rows = []
+    for region_id in parents:
+        ancestor_id, depth = region_id, 0
+        visited = set()  # защита от циклов в данных справочника
+        while ancestor_id in parents and ancestor_id not in visited:
+            visited.add(ancestor_id)
+            rows.append((ancestor_id, region_id, depth))
+            ancestor_id, depth = parents[ancestor_id], depth + 1
+    return rows
+
+
+class Dictionary(models.Model):
+    """
+    Справочник директа. Справочники общие для всех аккаунтов, поэтому метка времени изменений тоже общая
+    """
+    name = models.CharField(max_length=50, primary_key=True)  # название справочника в апи, например GeoRegions
+    last_changes_time = models.DateTimeField(null=True, blank=True)  # Timestamp последней проверки изменений
+
+    def __repr__(self):
+        return "<Dictionary(name='%s')>" % (self.name)
+
 
 class Account(models.Model):
     login = models.CharField(max_length=50, primary_key=True)
@@ -210,11 +531,22 @@ class Account(models.Model):
     # При сохранении в Acceess записей с DateTimeField возможны проблемы из-за разной точности временной метки подробнее: https://coderoad.ru/25088970/MS-Access-ODBC-%D1%81-%D0%BA%D0%BE%D0%BD%D1%84%D0%BB%D0%B8%D0%BA%D1%82%D0%BE%D0%BC-%D0%B7%D0%B0%D0%BF%D0%B8%D1%81%D0%B8-%D0%B2-%D1%82%D0%B0%D0%B1%D0%BB%D0%B8%D1%86%D1%83-PostgreSQL
     last_campaigns_changes_time = models.DateTimeField(null=True,
                                                        blank=True)  # Timestamp последней проверки изменний в кампаниях на сервере, которое сохранено в базе
-    last_dictionaries_changes_time = models.DateTimeField(null=True,
-                                                          blank=True)  # Timestamp последней проверки изменений в словарях
     sync_time = models.DateTimeField(null=True,
                                      blank=True)  # время завершения загрузки данных из директа
     disable = models.BooleanField(default=False)  # обрабатывать ли аккаунт в программах
+    last_stats_date = models.DateField(null=True, blank=True)  # последняя дата, за которую загружена статистика
+
+    def reset_direct(self, history=False):
+        """
+        Удаляет все объекты директа аккаунта: кампании, группы, объявления, фразы и их статистику. Удаление выполняется
+        одной транзакцией запросами на множество строк (см. bulk_delete), а не по объектам
+        :param history: записывать ли историю удаления
+        """
+        with transaction.atomic():
+            bulk_delete(Campaign._base_manager.filter(account=self), history=history)
+            # статистика удалена, ее надо загрузить заново
+            self.last_stats_date = None
+            self.save(update_fields=['last_stats_date'])
 
     def __repr__(self):
         return "<Account(login='%s')>" % (self.login)
@@ -271,19 +603,22 @@ class TextCampaign(Campaign):
     log = HistoricalRecords(related_name='history')
     objects = BulkHistoryManager()
     exclude_serialize_fields = {'account_id', 'campaign_ptr_id'}
+    # настройки текстовой кампании, одинаковые для всех кампаний
+    TEXT_CAMPAIGN_SETTINGS = {
+        "BiddingStrategy": {
+            "Search": {
+                "BiddingStrategyType": "HIGHEST_POSITION"
+            },
+            "Network": {
+                "BiddingStrategyType": "SERVING_OFF",
+            }
+        }
+    }
 
     def serialize(self, *args, **kwargs):
         ser_campaign = super().serialize(*args, **kwargs)
-        ser_campaign['TextCampaign'] = {
-            "BiddingStrategy": {
-                "Search": {
-                    "BiddingStrategyType": "HIGHEST_POSITION"
-                },
-                "Network": {
-                    "BiddingStrategyType": "SERVING_OFF",
-                }
-            }
-        }
+        # копия, что бы изменения одного запроса не попали в остальные
+        ser_campaign['TextCampaign'] = copy.deepcopy(self.TEXT_CAMPAIGN_SETTINGS)
         return ser_campaign
 
 
@@ -326,39 +661,64 @@ class AdGroup(models.Model, APIParserMixing):
     objects = BulkHistoryManager()
 
     @classmethod
-    def deserialize_nested(cls, obj, data, parent_filter):
-        # создаем объекты минус-фразы и добавляем в списко необработанных объектов
-        if not data['NegativeKeywords']:
-            return
-        for kw in data['NegativeKeywords']:
-            cls.modified_objects.setdefault(GroupNegativeKeyword, {}).setdefault('objects', []).append(
-                GroupNegativeKeyword(ad_group_id=obj.id, text=kw))
+    def deserialize_nested(cls, obj, data, parent_filter, modified_objects):
+        # создаем объекты минус-фразы и добавляем в списко необработанных объектов.
+        # Запись добавляется и для групп без минус-фраз, иначе у них не удалятся минус-фразы, удаленные в директе
+        negative_keywords = modified_objects.setdefault(GroupNegativeKeyword, {}).setdefault('objects', [])
+        for kw in data['NegativeKeywords'] or []:
+            negative_keywords.append(GroupNegativeKeyword(ad_group_id=obj.id, text=kw))
 
-        cls.modified_objects[GroupNegativeKeyword]['fields'] = ['ad_group_id', 'text']
-        cls.modified_objects[GroupNegativeKeyword]['key_fields'] = ['ad_group_id', 'text']
-        cls.modified_objects[GroupNegativeKeyword]['filter'] = {'ad_group__' + k: v for k, v in parent_filter.items()}
+        modified_objects[GroupNegativeKeyword]['fields'] = ['ad_group_id', 'text']
+        modified_objects[GroupNegativeKeyword]['key_fields'] = ['ad_group_id', 'text']
+        modified_objects[GroupNegativeKeyword]['filter'] = {'ad_group__' + k: v for k, v in parent_filter.items()}
 
     def __repr__(self):
         return "<AdGroup(id='%s', name='%s')>" % (self.id, self.name)
 
-    def serialize(self, *args, **kwargs):
+    def serialize(self, *args, region_ids=None, negative_keywords=None, **kwargs):
+        """
+        :param region_ids: идентификаторы регионов группы. Если None, загружаются из базы
+        :param negative_keywords: тексты минус-фраз группы. Если None, загружаются из базы
+        """
         gr_serialization = super().serialize(*args, **kwargs)
         # добавлем регионы
-        gr_serialization["RegionIds"] = list(self.regions.values_list('id', flat=True))
+        if region_ids is None:
+            region_ids = list(self.regions.values_list('id', flat=True))
+        gr_serialization["RegionIds"] = region_ids
         # добавляем минус-фразы
-        for neg_kw in self.groupnegativekeyword_set.all():
-            gr_serialization.setdefault("NegativeKeywords", {"Items": []})['Items'].append(neg_kw.text)
+        if negative_keywords is None:
+            negative_keywords = [neg_kw.text for neg_kw in self.groupnegativekeyword_set.all()]
+        if negative_keywords:
+            gr_serialization["NegativeKeywords"] = {"Items": negative_keywords}
         return gr_serialization
 
+    @classmethod
+    def serialize_many(cls, objs, exclude=None, include_null=False, batch_size=900):
+        # регионы и минус-фразы загружаются для всех групп двумя запросами на каждые batch_size групп
+        objs = list(objs)
+        ids = [obj.id for obj in objs]
+        regions = {}
+        negative_keywords = {}
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            for group_id, region_id in cls.regions.through.objects.filter(adgroup_id__in=batch).values_list(
+                    'adgroup_id', 'region_id'):
+                regions.setdefault(group_id, []).append(region_id)
+            for group_id, text in GroupNegativeKeyword.objects.filter(ad_group_id__in=batch).order_by(
+                    'id').values_list('ad_group_id', 'text'):
+                negative_keywords.setdefault(group_id, []).append(text)
+
+        plan = cls.serialize_plan(exclude)
+        return [obj.serialize(include_null=include_null, plan=plan,
+                              region_ids=regions.get(obj.id, []),
+                              negative_keywords=negative_keywords.get(obj.id, []))
+                for obj in objs]
+
     def delete_direct(self):
         self.state = 'DELETE'
         self.save()
-        for ad in self.textad_set.all():
-            ad.state = 'DELETE'
-            ad.save()
-        for kw in Keyword.objects.filter(ad_group=self).all():
-            kw.state = 'DELETE'
-            kw.save()
+        TextAd.objects.update_with_history(self.textad_set.all(), state='DELETE')
+        Keyword.objects.update_with_history(Keyword.objects.filter(ad_group=self), state='DELETE')
 
 
 class GroupNegativeKeyword(models.Model):
@@ -378,15 +738,67 @@ class Criterion(models.Model, APIParserMixing):
     id = models.BigIntegerField(primary_key=True)  # идентификтор в директе
     ad_group = models.ForeignKey(AdGroup, on_delete=CASCADE)
 
+    APPROVED_STATUSES = ['approved', 'approved_but_stalled']
+    PAYMENT_SUM_CACHE_PREFIX = 'direct:actual_payment_sum'
+    PAYMENT_SUM_CACHE_TIMEOUT = 24 * 60 * 60
+
     @cached_property
     def actual_payment_sum(self):
         # сумма оплат по критерию за год, если б ставки были как сейчас
+        return self.actual_payment_sums([self.id])[self.id]
+
+    @classmethod
+    def actual_payment_sums(cls, criterion_ids, chunk_size=900):
+        """
+        Суммы оплат за год для многих критериев. Критерии делятся на пачки по chunk_size, действия пачки загружаются
+        одним запросом. Суммы пачки кешируются одним значением до загрузки новых действий
+        (invalidate_actual_payment_sums), поэтому повторный обход тех же критериев не загружает действия
+        :return: {id критерия: сумма оплат}
+        """
+        cache = caches['direct']
+        criterion_ids = sorted(set(criterion_ids))
+        # в ключе дата, потому что каждый день меняется период
+        key_prefix = '%s:%s:%s:' % (cls.PAYMENT_SUM_CACHE_PREFIX, cache.get_or_set(
+            cls.PAYMENT_SUM_CACHE_PREFIX, time.time_ns, None), date.today().isoformat())
+        chunks = {}  # {ключ кеша: идентификаторы пачки}
+        for i in range(0, len(criterion_ids), chunk_size):
+            chunk = criterion_ids[i:i + chunk_size]
+            chunks[key_prefix + hashlib.md5(','.join(map(str, chunk)).encode()).hexdigest()] = chunk
+        keys = list(chunks)
+        cached = {}
+        for i in range(0, len(keys), chunk_size):
+            cached.update(cache.get_many(keys[i:i + chunk_size]))
+
+        rel = cls._meta.get_field('action')
+        action_model = rel.related_model
+        criterion_attname = rel.field.attname
         year_ago = date.today() - timedelta(days=365)
-        payment_sum = sum([a.actual_payment for a in self.action_set.filter(payment__gt=0,
-                                                                            status__in=['approved',
-                                                                                        'approved_but_stalled'],
-                                                                            click_time__date__gte=year_ago).all()])
-        return payment_sum
+        sums = {}
+        missed = {}
+        for key, chunk in chunks.items():
+            if key in cached:
+                sums.update(cached[key])
+                continue
+            chunk_sums = dict.fromkeys(chunk, 0)
+            # actual_payment считается в python, поэтому суммы группируются здесь, а не в базе
+            for action in action_model.objects.filter(**{criterion_attname + '__in': chunk}, payment__gt=0,
+                                                      status__in=cls.APPROVED_STATUSES,
+                                                      click_time__date__gte=year_ago).iterator():
+                chunk_sums[getattr(action, criterion_attname)] += action.actual_payment
+            missed[key] = chunk_sums
+            sums.update(chunk_sums)
+        cache.set_many(missed, cls.PAYMENT_SUM_CACHE_TIMEOUT)
+        return sums
+
+    @classmethod
+    def prefetch_actual_payment_sums(cls, criteria):
+        """
+        Заполняет actual_payment_sum у списка критериев, чтобы при обходе не было запроса на каждый критерий
+        """
+        sums = cls.actual_payment_sums([c.id for c in criteria])
+        for c in criteria:
+            c.__dict__['actual_payment_sum'] = sums[c.id]
+        return criteria
 
 
 class Keyword(Criterion):
@@ -398,6 +810,7 @@ class Keyword(Criterion):
 
     exclude_serialize_fields = {'criterion_ptr_id'}
     exclude_serialize_update_fields = exclude_serialize_fields | {'ad_group_id'}
+    serialize_names = {'text': 'Keyword'}
 
     text = models.CharField(max_length=4096)
     bid = models.IntegerField(blank=True, null=True)  # ставка в копейках
@@ -420,11 +833,6 @@ class Keyword(Criterion):
         obj, fields = super().deserialize(modified_data)
         return obj, fields
 
-    def serialize(self, *args, **kwargs):
-        keyword_serialization = super().serialize(*args, **kwargs)
-        keyword_serialization['Keyword'] = keyword_serialization.pop('Text')
-        return keyword_serialization
-
     def __repr__(self):
         return "<DirectKeyword(keyword='%s', bid='%s')>" % (
             self.keyword, self.bid or self.context_bid)
@@ -530,6 +938,20 @@ class DirectStats(models.Model, APIParserMixing):
     mobile_platform = models.CharField(max_length=20, choices=MOBILE_PLATFORM_CHOICES)
     slot = models.CharField(max_length=20, choices=SLOT_CHOICES)
 
+    # поля, которые однозначно определяют строку статистики. Первое поле - дата
+    NATURAL_KEY = ('date', 'criterion_id', 'ad_id', 'region_id', 'device', 'gender', 'age', 'carrier_type',
+                   'mobile_platform', 'slot')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'criterion', 'ad', 'region_id', 'device', 'gender', 'age',
+                                            'carrier_type', 'mobile_platform', 'slot'],
+                                    name='unique_direct_stats')
+        ]
+
+    def natural_key(self):
+        return tuple(getattr(self, name) for name in self.NATURAL_KEY)
+
     @classmethod
     def deserialize(cls, data):
         modified_data = data
@@ -545,6 +967,44 @@ class DirectStats(models.Model, APIParserMixing):
             self.date, self.criterion_id, self.clicks)
 
 
+class DirectStatsRollup(models.Model):
+    """
+    Свернутая статистика директа. Старая статистика DirectStats суммируется по кампании, группе и критерию
+    (см. direct.retention)
+    """
+    date = models.DateField()
+    shows = models.IntegerField()
+    clicks = models.IntegerField()
+    campaign = JoinField(Campaign, on_delete=CASCADE)
+    group = JoinField(AdGroup, on_delete=CASCADE)
+    criterion = JoinField(Criterion, on_delete=CASCADE)
+
+    class Meta:
+        abstract = True
+
+
+class DirectStatsDaily(DirectStatsRollup):
+    """
+    Статистика по дням
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'campaign', 'group', 'criterion'], name='unique_direct_stats_daily')
+        ]
+
+
+class DirectStatsWeekly(DirectStatsRollup):
+    """
+    Статистика по неделям. date - понедельник недели
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'campaign', 'group', 'criterion'], name='unique_direct_stats_weekly')
+        ]
+
+
 def multi_field_in(object_list):
     """
     Создает запрос аналог __in object_list для нескольких полей. object_list - список словарей. В словаре пары название поля - значение
@@ -555,3 +1015,166 @@ def multi_field_in(object_list):
         operator.or_,
         (Q(**values) for values in object_list)
     )
+
+
+def fast_bulk_insert(model, objs, batch_size=5000):
+    """
+    Быстрая вставка большого количества объектов без истории и сигналов. Первичный ключ должен быть автоинкрементным.
+    Для PostgreSQL используется COPY, для остальных баз - bulk_create большими пачками.
+    :param objs: список объектов, которые надо вставить
+    :param batch_size: размер пачки для bulk_create
+    :return:
+    """
+    if not objs:
+        return
+    using = router.db_for_write(model)
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        model._base_manager.using(using).bulk_create(objs, batch_size=batch_size)
+        return
+
+    fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+    buffer = io.StringIO()
+    for obj in objs:
+        buffer.write(copy_csv_row([f.get_db_prep_save(f.pre_save(obj, True), connection) for f in fields]))
+    buffer.seek(0)
+    qn = connection.ops.quote_name
+    sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+        qn(model._meta.db_table), ', '.join(qn(f.column) for f in fields))
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, buffer)
+
+
+def copy_csv_row(values):
+    """
+    Строка csv для COPY. В формате csv COPY считает NULL пустое значение без кавычек, а пустое значение в кавычках -
+    пустой строкой, поэтому None пишется без кавычек, а остальные значения - в кавычках.
+    csv.writer так не умеет: None он пишет как пустую строку в кавычках
+    """
+    return ','.join('' if value is None else '"%s"' % str(value).replace('"', '""') for value in values) + '\n'
+
+
+def changed_fields_since(cls, ids, since, batch_size=900):
+    """
+    Определяет по истории, какие поля объектов изменились после since: сравнивает последнюю версию объекта с версией
+    до начала изменений. Количество запросов не зависит от количества объектов, а только от количества пачек
+    :param cls: модель с историей
+    :param ids: идентификаторы объектов
+    :param since: время, после которого ищутся изменения
+    :param batch_size: сколько идентификаторов передается в один запрос
+    :return: {id: set(attname)}. Если версии до since в истории нет, измененными считаются все поля
+    """
+    history_model = get_history_model_for_model(cls)
+    field_names = [f.attname for f in cls._meta.fields]
+    ids = list(ids)
+    latest = {}
+    baselines = {}
+    for i in range(0, len(ids), batch_size):
+        chunk = ids[i:i + batch_size]
+        # последние версии объектов после since
+        chunk_latest = {}
+        for record in history_model.objects.filter(id__in=chunk, history_date__gt=since).order_by(
+                'history_date', 'history_id').values(*field_names).iterator():
+            chunk_latest[record['id']] = record
+        latest.update(chunk_latest)
+
+        # версии до начала изменений
+        baseline_ids = history_model.objects.filter(id__in=list(chunk_latest), history_date__lte=since).values(
+            'id').annotate(last_history_id=Max('history_id')).values('last_history_id')
+        baselines.update((record['id'], record) for record in
+                         history_model.objects.filter(history_id__in=baseline_ids).values(*field_names))
+
+    changes = {}
+    for obj_id, record in latest.items():
+        baseline = baselines.get(obj_id)
+        if baseline is None:
+            changes[obj_id] = set(field_names)
+        else:
+            changes[obj_id] = {name for name in field_names if record[name] != baseline[name]}
+    return changes
+
+
+def remap_ids(cls, id_map, batch_size=500):
+    """
+    Меняет первичные ключи объектов cls (отрицательные на полученные из директа) и все ссылки на них: внешние ключи,
+    один к одному, многие ко многим, JoinField статистики и записи истории. Выполняется несколькими UPDATE в одной
+    транзакции, объекты не пересоздаются. Ограничения внешних ключей должны быть отложенными (в django это так)
+    :param id_map: {старый id: новый id}
+    :param batch_size: сколько идентификаторов меняется одним UPDATE
+    :return:
+    """
+    if not id_map:
+        return
+    items = list(id_map.items())
+    # при multitable inheritance меняем ключи во всех таблицах цепочки, начиная с корневой
+    models_chain = list(reversed(cls._meta.get_parent_list())) + [cls]
+
+    def update_column(model, attname, base_filter=None):
+        # меняет значения колонки attname по id_map
+        for i in range(0, len(items), batch_size):
+            chunk = items[i:i + batch_size]
+            new_value = Case(*[When(**{attname: old}, then=Value(new)) for old, new in chunk], default=F(attname),
+                             output_field=models.BigIntegerField())
+            model._base_manager.filter(**{attname + '__in': [old for old, new in chunk]}).update(**{attname: new_value})
+
+    with transaction.atomic():
+        root = models_chain[0]
+        update_column(root, root._meta.pk.attname)
+        for model in models_chain:
+            # все ссылки на модель, включая скрытые (таблицы многие ко многим, история) и ссылки дочерних таблиц
+            for rel in model._meta.get_fields(include_parents=False, include_hidden=True):
+                if isinstance(rel, ForeignObjectRel) and rel.field.concrete:
+                    update_column(rel.related_model, rel.field.attname)
+            # в истории id объекта хранится в обычном поле
+            if getattr(model._meta, 'simple_history_manager_attribute', None):
+                update_column(get_history_model_for_model(model), 'id')
+
+
+def bulk_delete(queryset, history=True, batch_size=1000):
+    """
+    Удаляет объекты queryset и все объекты, которые на них ссылаются, запросами DELETE на множество строк, без загрузки
+    объектов и сигналов. Ссылающиеся объекты удаляются раньше объектов, на которые они ссылаются, учитываются
+    on_delete CASCADE, SET_NULL, DO_NOTHING и PROTECT. При multitable inheritance queryset должен быть по корневой
+    модели, дочерние таблицы удаляются как ссылающиеся на нее.
+    Вызывать внутри транзакции
+    :param history: записывать ли историю удаления для моделей с историей. Для этого объекты загружаются пачками
+    :return:
+    """
+    model = queryset.model
+    if history and getattr(model._meta, 'simple_history_manager_attribute', None):
+        _bulk_delete_history(queryset, batch_size)
+    # все ссылки на модель, включая скрытые (таблицы многие ко многим) и дочерние таблицы
+    for rel in model._meta.get_fields(include_parents=False, include_hidden=True):
+        if not isinstance(rel, ForeignObjectRel) or rel.many_to_many:
+            continue
+        related = rel.related_model._base_manager.filter(**{rel.field.name + '__in': queryset})
+        if rel.on_delete == CASCADE:
+            bulk_delete(related, history, batch_size)
+        elif rel.on_delete == SET_NULL:
+            related.update(**{rel.field.name: None})
+        elif rel.on_delete != DO_NOTHING and related.exists():
+            raise ProtectedError("Cannot delete %s: referenced by %s" % (model.__name__, rel.related_model.__name__),
+                                 related)
+    queryset._raw_delete(queryset.db)
+
+
+def _bulk_delete_history(queryset, batch_size):
+    # записи истории об удалении, как их создает simple_history при delete()
+    history_model = get_history_model_for_model(queryset.model)
+    history_date = timezone.now()
+    batch = []
+    for obj in queryset.iterator(chunk_size=batch_size):
+        batch.append(history_model(history_date=history_date, history_type='-',
+                                   **{f.attname: getattr(obj, f.attname) for f in history_model.tracked_fields}))
+        if len(batch) >= batch_size:
+            history_model.objects.bulk_create(batch)
+            batch = []
+    history_model.objects.bulk_create(batch)
+
+
+def invalidate_actual_payment_sums():
+    """
+    Сбрасывает кеш Criterion.actual_payment_sums. Вызывается после загрузки действий
+    """
+    # новая версия - новые ключи, старые значения удалятся по таймауту
+    caches['direct'].set(Criterion.PAYMENT_SUM_CACHE_PREFIX, time.time_ns(), None)
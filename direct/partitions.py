@@ -0,0 +1,114 @@
+"""
+Партиционирование таблицы статистики директа по месяцам.
+В PostgreSQL таблица direct_directstats секционирована по дате (PARTITION BY RANGE), у каждого месяца своя секция.
+Запросы и удаления за период затрагивают только секции этого периода. Старые месяцы удаляются целиком через DROP секции.
+В остальных базах таблица обычная, секции не создаются, а операции с периодами выполняются по индексу, который
+начинается с даты (unique_direct_stats).
+"""
+from datetime import date
+
+from django.db import connections, router, transaction
+
+from direct.models import DirectStats
+
+DEFAULT_PARTITION = 'direct_directstats_default'
+PARTITIONS_LOCK_ID = 73100  # ключ pg_advisory_xact_lock, под которым создаются секции
+
+
+def month_start(d):
+    return date(d.year, d.month, 1)
+
+
+def next_month(d):
+    return date(d.year + d.month // 12, d.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return '%s_y%04dm%02d' % (DirectStats._meta.db_table, month.year, month.month)
+
+
+def months(date_from, date_to):
+    # первые числа всех месяцев периода
+    month = month_start(date_from)
+    while month <= date_to:
+        yield month
+        month = next_month(month)
+
+
+def _connection():
+    return connections[router.db_for_write(DirectStats)]
+
+
+def is_partitioned(connection=None):
+    connection = connection or _connection()
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+                       "WHERE c.relname = %s", [DirectStats._meta.db_table])
+        return cursor.fetchone() is not None
+
+
+def ensure_partitions(date_from, date_to, connection=None):
+    """
+    Создает секции для всех месяцев периода, если их еще нет.
+    Аккаунты загружаются параллельно, а одновременные CREATE TABLE IF NOT EXISTS одной секции завершаются ошибкой,
+    поэтому секции создаются под блокировкой, которая держится до конца транзакции
+    """
+    connection = connection or _connection()
+    if not is_partitioned(connection):
+        return
+    qn = connection.ops.quote_name
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [PARTITIONS_LOCK_ID])
+        for month in months(date_from, date_to):
+            cursor.execute('CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)' % (
+                qn(partition_name(month)), qn(DirectStats._meta.db_table)), [month, next_month(month)])
+
+
+def drop_partitions_before(day, connection=None):
+    """
+    Удаляет статистику всех аккаунтов до day. Месяцы, которые целиком раньше day, удаляются вместе с секцией,
+    остаток - обычным удалением
+    :return:
+    """
+    connection = connection or _connection()
+    if is_partitioned(connection):
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT c.relname FROM pg_inherits i "
+                           "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+                           "WHERE p.relname = %s", [DirectStats._meta.db_table])
+            for name, in cursor.fetchall():
+                if name == DEFAULT_PARTITION:
+                    continue
+                year, month = int(name[-7:-3]), int(name[-2:])
+                if next_month(date(year, month, 1)) <= day:
+                    cursor.execute('DROP TABLE %s' % qn(name))
+    DirectStats.objects.filter(date__lt=day).delete()
+
+
+def partition_table(connection):
+    """
+    Превращает обычную таблицу статистики в секционированную (только PostgreSQL). Используется в миграции
+    """
+    table = DirectStats._meta.db_table
+    old_table = table + '_old'
+    with connection.cursor() as cursor:
+        cursor.execute('ALTER TABLE %s RENAME TO %s' % (table, old_table))
+        cursor.execute('ALTER TABLE %s DROP CONSTRAINT IF EXISTS unique_direct_stats' % old_table)
+        cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE (date)' % (table, old_table))
+        # в секционированной таблице уникальные ключи должны содержать дату
+        cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (id, date)' % table)
+        cursor.execute('ALTER TABLE %s ADD CONSTRAINT unique_direct_stats UNIQUE (date, criterion_id, ad_id, region_id, '
+                       'device, gender, age, carrier_type, mobile_platform, slot)' % table)
+        for column in ('campaign_id', 'group_id', 'ad_id', 'criterion_id'):
+            cursor.execute('CREATE INDEX %s_%s ON %s (%s)' % (table, column, table, column))
+        cursor.execute('CREATE TABLE %s PARTITION OF %s DEFAULT' % (DEFAULT_PARTITION, table))
+        cursor.execute('SELECT min(date), max(date) FROM %s' % old_table)
+        date_from, date_to = cursor.fetchone()
+    ensure_partitions(date_from or date.today(), next_month(date_to or date.today()), connection)
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO %s SELECT * FROM %s' % (table, old_table))
+        cursor.execute('ALTER SEQUENCE %s_id_seq OWNED BY %s.id' % (table, table))
+        cursor.execute('DROP TABLE %s' % old_table)
@@ -0,0 +1,129 @@
+"""
+Хранение статистики директа.
+Детальная статистика (DirectStats) нужна только за последние дни. Более старая сворачивается в статистику по дням
+(DirectStatsDaily), а еще более старая - по неделям (DirectStatsWeekly). Суммы кликов и показов по кампаниям, группам и
+критериям при этом не меняются. stats_values объединяет все три таблицы, поэтому читать статистику за любой период
+можно одинаково.
+"""
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum, Max
+from django.db.models.functions import TruncWeek
+
+from direct.models import DirectStats, DirectStatsDaily, DirectStatsWeekly
+from direct.partitions import drop_partitions_before
+
+ROLLUP_FIELDS = ('campaign_id', 'group_id', 'criterion_id')
+
+DEFAULT_RETENTION = {
+    'detail_days': 90,  # сколько дней хранится детальная статистика
+    'daily_days': 365,  # сколько дней хранится статистика по дням, дальше по неделям
+}
+
+
+def retention_settings():
+    return dict(DEFAULT_RETENTION, **getattr(settings, 'DIRECT_STATS_RETENTION', {}))
+
+
+def monday(day):
+    return day - timedelta(days=day.weekday())
+
+
+def rollup_stats(detail_days=None, daily_days=None, today=None):
+    """
+    Сворачивает детальную статистику старше detail_days дней в статистику по дням, а статистику по дням старше
+    daily_days - в статистику по неделям. Свернутые строки удаляются
+    :return: (первый день детальной статистики, первый день статистики по дням)
+    """
+    retention = retention_settings()
+    detail_days = retention['detail_days'] if detail_days is None else detail_days
+    daily_days = retention['daily_days'] if daily_days is None else daily_days
+    today = today or date.today()
+    detail_from = today - timedelta(days=detail_days)
+    # по неделям сворачиваются только целые недели
+    daily_from = monday(today - timedelta(days=daily_days))
+    with transaction.atomic():
+        _rollup(DirectStats.objects.filter(date__lt=detail_from), DirectStatsDaily, F('date'))
+        # старые месяцы удаляются вместе с секцией
+        drop_partitions_before(detail_from)
+        daily = DirectStatsDaily.objects.filter(date__lt=daily_from)
+        _rollup(daily, DirectStatsWeekly, TruncWeek('date'))
+        daily.delete()
+    return detail_from, daily_from
+
+
+def _rollup(source, target_model, period, batch_size=1000):
+    """
+    Суммирует строки source по периоду и ROLLUP_FIELDS и прибавляет суммы к строкам target_model
+    """
+    totals = source.annotate(period=period).values('period', *ROLLUP_FIELDS).annotate(
+        total_clicks=Sum('clicks'), total_shows=Sum('shows')).order_by('period')
+    current_period = None
+    existing = {}
+    to_create = []
+    to_update = []
+
+    def flush():
+        target_model.objects.bulk_create(to_create, batch_size=batch_size)
+        target_model.objects.bulk_update(to_update, ['clicks', 'shows'], batch_size=batch_size)
+        to_create.clear()
+        to_update.clear()
+
+    for row in totals.iterator():
+        if row['period'] != current_period:
+            flush()
+            current_period = row['period']
+            # строки, которые уже свернуты за этот период
+            existing = {tuple(getattr(obj, name) for name in ROLLUP_FIELDS): obj
+                        for obj in target_model.objects.filter(date=current_period)}
+        key = tuple(row[name] for name in ROLLUP_FIELDS)
+        if key in existing:
+            obj = existing[key]
+            obj.clicks += row['total_clicks']
+            obj.shows += row['total_shows']
+            to_update.append(obj)
+        else:
+            to_create.append(target_model(date=current_period, clicks=row['total_clicks'],
+                                          shows=row['total_shows'], **dict(zip(ROLLUP_FIELDS, key))))
+    flush()
+
+
+def detail_stats_from(account):
+    """
+    Первый день, за который можно загружать детальную статистику аккаунта. Более ранние дни аккаунта уже свернуты,
+    поэтому статистику за них нельзя загружать повторно, иначе она будет посчитана дважды.
+    Считается по сверткам самого аккаунта: у нового аккаунта или аккаунта, объекты которого удалены вместе со
+    свертками, загружается вся статистика, а в свертки она попадет при следующем rollup_stats
+    :return: дата или None, если у аккаунта нет свернутой статистики
+    """
+    last_daily = DirectStatsDaily.objects.filter(campaign__account=account).aggregate(last=Max('date'))['last']
+    last_weekly = DirectStatsWeekly.objects.filter(campaign__account=account).aggregate(last=Max('date'))['last']
+    days = [d + timedelta(days=1) for d in [last_daily] if d] + [d + timedelta(days=7) for d in [last_weekly] if d]
+    return max(days) if days else None
+
+
+def stats_values(date_from=None, date_to=None, **filters):
+    """
+    Статистика за период в разрезе даты, кампании, группы и критерия. Объединяет детальную статистику и свертки.
+    Для статистики по неделям date - понедельник недели
+    :param filters: фильтры, которые применяются ко всем таблицам, например campaign__account=account
+    :return: queryset словарей {date, campaign_id, group_id, criterion_id, clicks, shows}
+    """
+    fields = ('date',) + ROLLUP_FIELDS
+    period_filter = {}
+    if date_from:
+        period_filter['date__gte'] = date_from
+    if date_to:
+        period_filter['date__lte'] = date_to
+    weekly_filter = dict(period_filter)
+    if date_from:
+        # неделя, в которую попадает date_from
+        weekly_filter['date__gte'] = monday(date_from)
+
+    detail = DirectStats.objects.filter(**filters, **period_filter).values(*fields).annotate(
+        clicks_sum=Sum('clicks'), shows_sum=Sum('shows')).values(*fields, 'clicks_sum', 'shows_sum').order_by()
+    daily = DirectStatsDaily.objects.filter(**filters, **period_filter).values(*fields, 'clicks', 'shows').order_by()
+    weekly = DirectStatsWeekly.objects.filter(**filters, **weekly_filter).values(*fields, 'clicks', 'shows').order_by()
+    return daily.union(weekly, detail, all=True)
@@ -0,0 +1,229 @@
+"""
+Планировщик запросов к апи директа с учетом баллов (units).
+Директ списывает баллы за каждый запрос и возвращает остаток в заголовке Units в формате "списано/осталось/суточный лимит".
+Баллы восстанавливаются равномерно в течение суток. Если баллов не хватает, директ возвращает ошибку 152.
+"""
+import functools
+import heapq
+import itertools
+import re
+import threading
+import time
+
+# приоритеты запросов, чем меньше, тем раньше выполняется
+BIDS_PRIORITY = 0
+DEFAULT_PRIORITY = 1
+REPORTS_PRIORITY = 2
+DICTIONARIES_PRIORITY = 3
+
+METHOD_PRIORITIES = {
+    'set_keywordbids': BIDS_PRIORITY,
+    'reports': REPORTS_PRIORITY,
+    'get_dictionaries': DICTIONARIES_PRIORITY,
+    'checkDictionaries_changes': DICTIONARIES_PRIORITY,
+}
+
+# примерная стоимость запросов в баллах. Используется, пока директ не вернул остаток баллов
+DEFAULT_COST = 10
+METHOD_COSTS = {
+    'set_keywordbids': 25,
+    'reports': 0,  # отчеты не тратят баллы
+    'get_dictionaries': 1,
+    'checkDictionaries_changes': 1,
+}
+
+NOT_ENOUGH_UNITS_ERROR = 152
+# текст ошибки 152 на английском и русском
+NOT_ENOUGH_UNITS_MESSAGES = ('not enough units', 'недостаточно баллов')
+# код ошибки в тексте ответа директа: "error_code": 152
+NOT_ENOUGH_UNITS_CODE_RE = re.compile(r"""['"]?error_code['"]?\s*[:=]\s*['"]?%s\b""" % NOT_ENOUGH_UNITS_ERROR)
+
+
+def parse_units(header):
+    """
+    Разбирает заголовок Units
+    :return: (списано, осталось, суточный лимит)
+    """
+    spent, rest, limit = (int(v) for v in header.split('/'))
+    return spent, rest, limit
+
+
+def is_units_error(exc):
+    # ошибка 152 - недостаточно баллов
+    code = getattr(exc, 'error_code', None) or getattr(exc, 'code', None)
+    if code is not None:
+        return str(code) == str(NOT_ENOUGH_UNITS_ERROR)
+    # у исключения нет кода: ищем поле error_code или точный текст ошибки, а не любое число 152 в сообщении
+    text = str(exc)
+    if NOT_ENOUGH_UNITS_CODE_RE.search(text):
+        return True
+    return any(message in text.lower() for message in NOT_ENOUGH_UNITS_MESSAGES)
+
+
+class LoginUnits:
+    """
+    Остаток баллов одного логина
+    """
+    default_wait = 60  # пауза после ошибки 152, если суточный лимит неизвестен, сек
+    max_wait = 600  # максимальная пауза, пауза удваивается после каждой ошибки подряд
+
+    def __init__(self):
+        self.remaining = None  # None - остаток неизвестен, запросы не ограничиваются
+        self.limit = None
+        self.updated_at = time.monotonic()
+        self.queue = []  # ожидающие запросы [(приоритет, номер)]
+        self.in_flight = 0
+        self.backoff = 0  # текущая пауза после ошибок 152, если лимит неизвестен
+        self.blocked_until = 0  # до какого времени запросы не выполняются
+
+    def refill(self, now):
+        # баллы восстанавливаются равномерно в течение суток
+        if self.remaining is not None and self.limit:
+            self.remaining = min(self.limit, self.remaining + (now - self.updated_at) * self.limit / 86400)
+        self.updated_at = now
+
+    def wait_time(self, cost, now):
+        """
+        :return: сколько секунд ждать, пока баллов хватит на запрос стоимостью cost
+        """
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.refill(now)
+        if self.remaining is None or self.remaining >= cost:
+            return 0
+        return (cost - self.remaining) * 86400 / self.limit
+
+    def update(self, rest, limit, now):
+        # без суточного лимита остаток не восстановить, поэтому он считается неизвестным
+        self.remaining = rest if limit else None
+        self.limit = limit or None
+        self.updated_at = now
+
+    def exhausted(self, now):
+        """
+        Директ ответил ошибкой 152. Если лимит известен, остаток обнуляется и восстанавливается по лимиту,
+        иначе запросы приостанавливаются на паузу, которая растет с каждой ошибкой подряд
+        """
+        if self.limit:
+            self.refill(now)
+            self.remaining = 0
+        else:
+            self.backoff = min(self.max_wait, self.backoff * 2 or self.default_wait)
+            self.blocked_until = now + self.backoff
+
+    def succeeded(self):
+        self.backoff = 0
+
+
+class UnitsScheduler:
+    """
+    Обертка над yandex_direct_api.Api. Методы вызываются так же, как у Api, но запросы одного логина выполняются
+    по очереди приоритетов (ставки, потом остальное, потом отчеты, потом справочники) и только если хватает баллов.
+    :param api: объект yandex_direct_api.Api
+    :param units_reader: функция (api, login) -> заголовок Units последнего ответа или None. Если не задана,
+    остаток баллов неизвестен: запросы выполняются без ограничений, а после ошибки 152 логин приостанавливается
+    на паузу LoginUnits.default_wait, которая удваивается после каждой следующей ошибки (до max_wait)
+    :param max_concurrent: сколько запросов одного логина выполняется одновременно
+    :param max_retries: сколько раз повторять запрос после ошибки 152
+    """
+
+    def __init__(self, api, units_reader=None, max_concurrent=5, max_retries=3):
+        self.api = api
+        self.units_reader = units_reader
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self._logins = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if not callable(attr):
+            return attr
+        return functools.partial(self.call, name)
+
+    def units(self, login):
+        """
+        :return: известный остаток баллов логина или None
+        """
+        with self._condition:
+            state = self._logins.get(login)
+            return state.remaining if state else None
+
+    def update_units(self, login, header):
+        """
+        Обновляет остаток баллов по заголовку Units
+        """
+        spent, rest, limit = parse_units(header)
+        with self._condition:
+            self._state(login).update(rest, limit, time.monotonic())
+            self._condition.notify_all()
+
+    def call(self, method_name, *args, **kwargs):
+        """
+        Выполняет метод api с учетом очереди и баллов логина client_login
+        """
+        login = kwargs.get('client_login')
+        cost = METHOD_COSTS.get(method_name, DEFAULT_COST)
+        priority = METHOD_PRIORITIES.get(method_name, DEFAULT_PRIORITY)
+        for attempt in itertools.count():
+            self._acquire(login, priority, cost)
+            try:
+                result = getattr(self.api, method_name)(*args, **kwargs)
+            except Exception as e:
+                if not is_units_error(e) or attempt >= self.max_retries:
+                    raise
+                # баллы закончились, ждем восстановления
+                self._exhausted(login)
+                continue
+            finally:
+                self._release(login)
+            self._succeeded(login)
+            self._read_units(login)
+            return result
+
+    def _state(self, login):
+        if login not in self._logins:
+            self._logins[login] = LoginUnits()
+        return self._logins[login]
+
+    def _acquire(self, login, priority, cost):
+        # ждем, пока запрос будет первым в очереди логина и на него хватит баллов
+        with self._condition:
+            state = self._state(login)
+            entry = (priority, next(self._counter))
+            heapq.heappush(state.queue, entry)
+            while True:
+                if state.queue[0] == entry and state.in_flight < self.max_concurrent:
+                    wait = state.wait_time(cost, time.monotonic())
+                    if wait <= 0:
+                        break
+                    self._condition.wait(wait)
+                else:
+                    self._condition.wait()
+            heapq.heappop(state.queue)
+            state.in_flight += 1
+            if state.remaining is not None:
+                state.remaining -= cost
+            self._condition.notify_all()
+
+    def _release(self, login):
+        with self._condition:
+            self._state(login).in_flight -= 1
+            self._condition.notify_all()
+
+    def _exhausted(self, login):
+        with self._condition:
+            self._state(login).exhausted(time.monotonic())
+            self._condition.notify_all()
+
+    def _succeeded(self, login):
+        with self._condition:
+            self._state(login).succeeded()
+
+    def _read_units(self, login):
+        if not self.units_reader:
+            return
+        header = self.units_reader(self.api, login)
+        if header:
+            self.update_units(login, header)
@@ -1,9 +1,10 @@
 import datetime
 from collections import OrderedDict
+from unittest import mock
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 
-from direct.api_manager import DirectAPI
+from direct.api_manager import DirectAPI, result_id
 from direct.models import *
 from unify_context.models import ProgramCampaign, Program
 from django.conf import settings
@@ -32,6 +33,8 @@ class TestDirectAPI(TestCase):
         #         api.get_keywords(cmp.id)
         #         api.get_stats()
         self.assertGreater(Region.objects.count(), 0)
+        self.assertEqual(len(Region.cached()), Region.objects.count())
+        self.assertIsNotNone(Dictionary.objects.get(name='GeoRegions').last_changes_time)
         self.assertGreater(TextCampaign.objects.count(), 0)
         self.assertGreater(AdGroup.objects.count(), 0)
         self.assertGreater(GroupNegativeKeyword.objects.count(), 0)
@@ -51,6 +54,283 @@ class TestDirectAPI(TestCase):
 
         self.api.load_data()
 
+    def test_bulk_create_multitable(self):
+        cmp = TextCampaign.objects.create(name='tests', account=self.acc, id=-1)
+        group = AdGroup.objects.create(name='test_gr', campaign=cmp, id=-1)
+        kwds = [Keyword(id=-i, ad_group=group, text='фраза %s' % i) for i in range(1, 6)]
+        Keyword.objects.bulk_create(kwds)
+        self.assertEqual(Criterion.objects.filter(ad_group=group).count(), 5)
+        self.assertEqual(Keyword.objects.filter(ad_group=group).count(), 5)
+        self.assertEqual(Keyword.log.filter(ad_group=group, history_type='+').count(), 5)
+
+    def test_sync_response_batches(self):
+        cmp = TextCampaign.objects.create(name='tests', account=self.acc, id=-1)
+        group = AdGroup.objects.create(name='test_gr', campaign=cmp, id=-1)
+        Keyword.objects.create(id=-100, ad_group=group, text='старая фраза')
+        items = ({'Id': -i, 'AdGroupId': -1, 'Keyword': 'фраза %s' % i, 'Bid': 10_000_000, 'ContextBid': 0}
+                 for i in range(1, 6))
+        pks = Keyword.sync_response(items, filter={'ad_group': group}, batch_size=2)
+        self.assertEqual(sorted(pks), [-5, -4, -3, -2, -1])
+        # фраза, которой нет в ответе, удалена после обработки всех пачек
+        self.assertEqual(set(Keyword.objects.filter(ad_group=group).values_list('id', flat=True)), set(pks))
+
+    def test_sync_negative_keywords_batches(self):
+        cmp = TextCampaign.objects.create(name='tests', account=self.acc, id=-1)
+        for id, texts in [(-1, ['минус 1', 'минус 2']), (-2, ['минус 3'])]:
+            group = AdGroup.objects.create(name='test_gr', campaign=cmp, id=id)
+            for text in texts:
+                group.groupnegativekeyword_set.create(text=text)
+        items = [{'Id': -1, 'CampaignId': -1, 'Name': 'test_gr', 'NegativeKeywords': ['минус 1']},
+                 {'Id': -2, 'CampaignId': -1, 'Name': 'test_gr', 'NegativeKeywords': None}]
+        AdGroup.sync_response(items, filter={'campaign': cmp}, batch_size=1)
+        # у группы без минус-фраз в ответе удалены все минус-фразы, хотя в ее пачке нет ни одной минус-фразы
+        self.assertEqual(set(GroupNegativeKeyword.objects.values_list('ad_group_id', 'text')), {(-1, 'минус 1')})
+
+    def test_reset_direct(self):
+        cmp = TextCampaign.objects.create(name='tests', account=self.acc, id=-1)
+        group = AdGroup.objects.create(name='test_gr', campaign=cmp, id=-1)
+        GroupNegativeKeyword.objects.create(ad_group=group, text='минус')
+        Keyword.objects.create(id=-1, ad_group=group, text='фраза')
+        self.acc.reset_direct(history=True)
+        self.assertFalse(Campaign.objects.filter(account=self.acc).exists())
+        self.assertFalse(AdGroup.objects.filter(id=-1).exists())
+        self.assertFalse(Criterion.objects.filter(id=-1).exists())
+        self.assertFalse(GroupNegativeKeyword.objects.filter(ad_group_id=-1).exists())
+        self.assertEqual(Keyword.log.filter(id=-1, history_type='-').count(), 1)
+
+    def test_dispatch_items_result_count(self):
+        self.api.account = self.acc
+        # директ вернул один результат на два объекта: вся пачка считается неотправленной
+        results = self.api.dispatch_items(lambda params, client_login: [{'Id': 1}], 'Keywords', [{}, {}])
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(result_id(result) is None for result in results))
+
+    def test_send_bids(self):
+        calls = []
+
+        class FakeBidsApi:
+            def set_keywordbids(self, params, client_login):
+                ids = [bid['KeywordId'] for bid in params['KeywordBids']]
+                calls.append((client_login, ids))
+                if -5 in ids:
+                    raise Exception('request failed')
+                return [{'Errors': [{'Code': 8800}]} if id == -2 else {'KeywordId': id} for id in ids]
+
+        other_acc = Account.objects.create(login='other_login', auth_token='token')
+        for id, acc in [(-1, self.acc), (-2, other_acc)]:
+            cmp = TextCampaign.objects.create(name='tests', account=acc, id=id)
+            AdGroup.objects.create(name='test_gr', campaign=cmp, id=id)
+        for id in range(-1, -8, -1):
+            Keyword.objects.create(id=id, ad_group_id=-1 if id > -6 else -2, text='фраза %s' % id, bid=100)
+        kwds = list(Keyword.objects.order_by('-id'))
+        for kw in kwds:
+            if kw.id != -4:  # ставка не изменилась и не отправляется
+                kw.bid = 200
+        unknown = Keyword(id=-100, bid=200)
+
+        api = self.api.account_context(self.acc)
+        api.ya_api = FakeBidsApi()
+        api.write_limits = dict(api.write_limits, keywordbids=2)
+        failed = api.send_bids(kwds + [unknown], workers=2)
+
+        # ставки каждого логина делятся на пачки по write_limits
+        self.assertEqual(sorted(calls), sorted([(self.acc.login, [-1, -2]), (self.acc.login, [-3, -5]),
+                                                ('other_login', [-6, -7])]))
+        # ошибка фразы и ошибка запроса всей пачки попадают в неотправленные вместе с фразами, которых нет в базе
+        self.assertEqual(sorted(kw.id for kw in failed), [-100, -5, -3, -2])
+        self.assertEqual(dict(Keyword.objects.values_list('id', 'bid')),
+                         {-1: 200, -2: 100, -3: 100, -4: 100, -5: 100, -6: 200, -7: 200})
+
+    def test_remap_ids(self):
+        cmp = TextCampaign.objects.create(name='tests', account=self.acc, id=-1)
+        reg = Region.objects.create(id=0, geo_region_name='All', geo_region_type='World')
+        for id in [-1, -2]:
+            group = AdGroup.objects.create(name='test_gr', campaign=cmp, id=id)
+            group.regions.add(reg)
+            group.groupnegativekeyword_set.create(text='стоп фраза')
+            TextAd.objects.create(ad_group=group, title='tests', title2='test2', text='tests text', mobile='NO',
+                                  id=id, href='http://ya.ru')
+            Keyword.objects.create(id=id, ad_group=group, text='фраза')
+
+        remap_ids(TextCampaign, {-1: 101})
+        remap_ids(AdGroup, {-1: 201, -2: 202}, batch_size=1)
+
+        # отрицательные id заменены во всех таблицах цепочки наследования и в истории
+        self.assertEqual(list(Campaign.objects.values_list('id', flat=True)), [101])
+        self.assertEqual(list(TextCampaign.objects.values_list('id', flat=True)), [101])
+        self.assertEqual(set(TextCampaign.log.values_list('id', flat=True)), {101})
+        self.assertEqual(set(AdGroup.objects.values_list('id', 'campaign_id')), {(201, 101), (202, 101)})
+        self.assertEqual(set(AdGroup.log.values_list('id', flat=True)), {201, 202})
+        # внешние ключи дочерних таблиц и их истории
+        for model in [TextAd, Keyword, GroupNegativeKeyword]:
+            self.assertEqual(set(model.objects.values_list('ad_group_id', flat=True)), {201, 202})
+            self.assertEqual(set(model.log.values_list('ad_group_id', flat=True)), {201, 202})
+        self.assertEqual(set(AdGroup.regions.through.objects.values_list('adgroup_id', flat=True)), {201, 202})
+
+    def test_copy_csv_row(self):
+        # NULL без кавычек, пустая строка в кавычках
+        self.assertEqual(copy_csv_row([None, '', 1, 'a"b']), ',"","1","a""b"\n')
+
+    def test_change_state_without_history(self):
+        cmp = Campaign.objects.create(name='dynamic', account=self.acc, id=-2, type='DYNAMIC_TEXT_CAMPAIGN',
+                                      state='ON')
+        with mock.patch.object(self.api, 'select_ids_call', return_value=[{'Id': -2}]):
+            self.api.suspend_campaigns([cmp])
+        self.assertEqual(Campaign.objects.get(id=-2).state, 'SUSPENDED')
+
+    def test_detail_stats_from_per_account(self):
+        from direct.retention import detail_stats_from
+        cmp = TextCampaign.objects.create(name='tests', account=self.acc, id=-1)
+        group = AdGroup.objects.create(name='test_gr', campaign=cmp, id=-1)
+        Keyword.objects.create(id=-1, ad_group=group, text='фраза')
+        DirectStatsDaily.objects.create(date=datetime.date(2020, 1, 10), shows=10, clicks=1, campaign_id=-1,
+                                        group_id=-1, criterion_id=-1)
+        # аккаунт, добавленный после свертки, загружает всю статистику
+        new_acc = Account.objects.create(login='new_login', auth_token='token')
+        self.assertEqual(detail_stats_from(self.acc), datetime.date(2020, 1, 11))
+        self.assertIsNone(detail_stats_from(new_acc))
+
+    def test_prune_history(self):
+        from direct.history import prune_history
+        cmp = TextCampaign.objects.create(name='tests', account=self.acc, id=-1)
+        for name in ['tests 1', 'tests 2']:
+            cmp.name = name
+            cmp.save()
+        self.acc.sync_time = datetime.datetime.now()
+        self.acc.save()
+        cmp.name = 'tests 3'
+        cmp.save()
+        prune_history()
+        # остается версия до sync_time и изменения после него
+        self.assertEqual(list(TextCampaign.log.filter(id=-1).order_by('history_date').values_list('name', flat=True)),
+                         ['tests 2', 'tests 3'])
+        self.assertEqual(changed_fields_since(TextCampaign, [-1], self.acc.sync_time)[-1], {'name'})
+
+    def test_region_tree(self):
+        world = Region.objects.create(id=-1, geo_region_name='Мир', geo_region_type='World')
+        country = Region.objects.create(id=-2, geo_region_name='Россия', geo_region_type='Country', parent=world)
+        city = Region.objects.create(id=-3, geo_region_name='Москва', geo_region_type='City', parent=country)
+        Region._cache = None  # регионы созданы в обход кеша
+        Region.rebuild_tree()
+        self.assertEqual(set(Region.descendant_ids(-1)), {-1, -2, -3})
+        self.assertEqual(set(Region.descendant_ids(-2, include_self=False)), {-3})
+        self.assertEqual(list(city.ancestors()), [country, world])
+        self.assertEqual(list(city.descendants()), [])
+        Region._cache = None
+        # цикл в родителях не зацикливает обход
+        self.assertEqual(sorted(region_tree_rows({1: 2, 2: 1})), [(1, 1, 0), (1, 2, 1), (2, 1, 1), (2, 2, 0)])
+
+    def test_actual_payment_sums(self):
+        cmp = TextCampaign.objects.create(name='tests', account=self.acc, id=-1)
+        group = AdGroup.objects.create(name='test_gr', campaign=cmp, id=-1)
+        kwds = Criterion.prefetch_actual_payment_sums(
+            [Keyword.objects.create(id=-i, ad_group=group, text='фраза %s' % i) for i in range(1, 4)])
+        with self.assertNumQueries(0):
+            # суммы уже посчитаны
+            self.assertEqual([k.actual_payment_sum for k in kwds], [0, 0, 0])
+        # суммы берутся из кеша: запрос версии и запрос значений, действия не загружаются
+        with self.assertNumQueries(2):
+            self.assertEqual(Criterion.actual_payment_sums([k.id for k in kwds]), {-1: 0, -2: 0, -3: 0})
+        # по пачкам: две пачки, суммы каждой в одной записи кеша
+        self.assertEqual(Criterion.actual_payment_sums([k.id for k in kwds], chunk_size=2), {-1: 0, -2: 0, -3: 0})
+        with self.assertNumQueries(2):
+            self.assertEqual(Criterion.actual_payment_sums([k.id for k in kwds], chunk_size=2),
+                             {-1: 0, -2: 0, -3: 0})
+
+    def stats_row(self, day, clicks=1, shows=10, region_id=225, criterion_id=-1, campaign_id=-1, group_id=-1,
+                  ad_id=-1):
+        # строка отчета директа в том виде, в каком ее возвращает апи
+        return OrderedDict([('Date', day.isoformat()), ('CampaignId', str(campaign_id)),
+                            ('AdGroupId', str(group_id)), ('AdId', str(ad_id)),
+                            ('CriterionId', str(criterion_id)), ('Clicks', str(clicks)),
+                            ('Impressions', str(shows)), ('Device', 'DESKTOP'), ('TargetingLocationId', str(region_id)),
+                            ('Gender', 'UNKNOWN'), ('Age', 'UNKNOWN'), ('CarrierType', 'UNKNOWN'),
+                            ('MobilePlatform', 'UNKNOWN'), ('Slot', 'OTHER')])
+
+    def create_stats_objects(self):
+        cmp = TextCampaign.objects.create(name='tests', account=self.acc, id=-1)
+        group = AdGroup.objects.create(name='test_gr', campaign=cmp, id=-1)
+        TextAd.objects.create(ad_group=group, title='tests', title2='test2', text='tests text', mobile='NO', id=-1,
+                              href='http://ya.ru')
+        Keyword.objects.create(id=-1, ad_group=group, text='фраза')
+
+    def test_ingest_stats_today_only(self):
+        self.create_stats_objects()
+        last_date = self.api.yesterday - datetime.timedelta(days=1)
+        Account.objects.filter(pk=self.acc.pk).update(last_stats_date=last_date)
+        self.acc.refresh_from_db()
+        api = self.api.account_context(self.acc)
+        # строки за сегодня отбрасываются, последняя дата статистики не должна сброситься
+        api.ingest_stats([self.stats_row(api.today)])
+        self.acc.refresh_from_db()
+        self.assertEqual(self.acc.last_stats_date, last_date)
+        self.assertEqual(DirectStats.objects.count(), 0)
+
+    def upsert_stats(self, report):
+        api = self.api.account_context(self.acc)
+        api.stats_chunk_size = 2  # строки одной даты попадают в разные пачки
+        api.ingest_stats(report, upsert=True)
+        return {(stat.date, stat.region_id): (stat.id, stat.clicks)
+                for stat in DirectStats.objects.filter(campaign__account=self.acc)}
+
+    def test_upsert_stats_insert(self):
+        self.create_stats_objects()
+        day1, day2 = self.api.yesterday - datetime.timedelta(days=1), self.api.yesterday
+        stats = self.upsert_stats([self.stats_row(day1, clicks=1), self.stats_row(day1, clicks=2, region_id=1),
+                                   self.stats_row(day2, clicks=3)])
+        self.assertEqual({key: clicks for key, (id, clicks) in stats.items()},
+                         {(day1, 225): 1, (day1, 1): 2, (day2, 225): 3})
+
+    def test_upsert_stats_update(self):
+        self.create_stats_objects()
+        day1, day2 = self.api.yesterday - datetime.timedelta(days=1), self.api.yesterday
+        before = self.upsert_stats([self.stats_row(day1, clicks=1), self.stats_row(day2, clicks=3)])
+        after = self.upsert_stats([self.stats_row(day1, clicks=5), self.stats_row(day2, clicks=3)])
+        # строка с тем же естественным ключом обновляется на месте, а не пересоздается
+        self.assertEqual(after, {(day1, 225): (before[(day1, 225)][0], 5), (day2, 225): before[(day2, 225)]})
+
+    def test_upsert_stats_delete(self):
+        self.create_stats_objects()
+        days = [self.api.yesterday - datetime.timedelta(days=n) for n in (3, 2, 1, 0)]
+        self.upsert_stats([self.stats_row(day) for day in days] + [self.stats_row(days[3], region_id=1)])
+        # за days[1] и days[2] в отчете строк больше нет, за days[3] пропала одна строка
+        stats = self.upsert_stats([self.stats_row(days[0]), self.stats_row(days[3])])
+        self.assertEqual(set(stats), {(days[0], 225), (days[3], 225)})
+
+    def create_detail_stats(self, clicks_by_date):
+        self.create_stats_objects()
+        for region_id, (day, clicks) in enumerate(clicks_by_date):
+            DirectStats.objects.create(date=day, clicks=clicks, shows=clicks * 10, region_id=region_id,
+                                       campaign_id=-1, group_id=-1, ad_id=-1, criterion_id=-1)
+
+    def test_rollup_stats(self):
+        from direct.retention import rollup_stats
+        day = datetime.date
+        self.create_detail_stats([(day(2020, 2, 9), 8), (day(2020, 2, 10), 1), (day(2020, 2, 10), 2),
+                                  (day(2020, 2, 16), 3), (day(2020, 2, 17), 7), (day(2020, 2, 20), 4),
+                                  (day(2020, 2, 25), 5)])
+        # детальная статистика с 23.02, по дням - с понедельника 17.02
+        self.assertEqual(rollup_stats(detail_days=10, daily_days=14, today=day(2020, 3, 4)),
+                         (day(2020, 2, 23), day(2020, 2, 17)))
+        self.assertEqual(list(DirectStats.objects.values_list('date', 'clicks')), [(day(2020, 2, 25), 5)])
+        self.assertEqual(list(DirectStatsDaily.objects.order_by('date').values_list('date', 'clicks', 'shows')),
+                         [(day(2020, 2, 17), 7, 70), (day(2020, 2, 20), 4, 40)])
+        # воскресенье 16.02 относится к неделе с понедельника 10.02, воскресенье 09.02 - к предыдущей
+        self.assertEqual(list(DirectStatsWeekly.objects.order_by('date').values_list('date', 'clicks', 'shows')),
+                         [(day(2020, 2, 3), 8, 80), (day(2020, 2, 10), 6, 60)])
+
+    def test_stats_values(self):
+        from direct.retention import rollup_stats, stats_values
+        day = datetime.date
+        self.create_detail_stats([(day(2020, 2, 10), 1), (day(2020, 2, 17), 2), (day(2020, 2, 20), 3),
+                                  (day(2020, 2, 25), 4), (day(2020, 2, 25), 5)])
+        rollup_stats(detail_days=10, daily_days=14, today=day(2020, 3, 4))
+        # каждая строка статистики попадает только в одну таблицу
+        self.assertEqual(sorted((row['date'], row['clicks']) for row in stats_values(campaign__account=self.acc)),
+                         [(day(2020, 2, 10), 1), (day(2020, 2, 17), 2), (day(2020, 2, 20), 3),
+                          (day(2020, 2, 25), 9)])
+        self.assertEqual(sum(row['clicks'] for row in stats_values(date_from=day(2020, 2, 18))), 12)
+
     def test_get_stats(self):
         api = DirectAPI()
         api.get_stats()
@@ -142,4 +422,25 @@ class TestDirectAPI(TestCase):
         #проверить корректность изменение статусов объявлений на модерации
 
 
+class TestDirectAPIConcurrent(TransactionTestCase):
+    # аккаунты обрабатываются в потоках со своими соединениями, поэтому данные теста должны быть в базе, а не в
+    # незавершенной транзакции TestCase
+
+    def setUp(self) -> None:
+        self.api = DirectAPI(accounts=OrderedDict({settings.DIRECT['login']: settings.DIRECT['token']}),
+                             sandbox=True)
+        self.acc = Account.objects.create(login=settings.DIRECT['login'], auth_token=settings.DIRECT['token'])
+        Account.objects.create(login='unknown_login', auth_token='bad_token')
+
+    def test_load_data_concurrent(self):
+        errors = self.api.load_data(workers=2)
+        # ошибка в одном аккаунте не мешает загрузке остальных
+        self.assertIn('unknown_login', errors)
+        self.assertNotIn(self.acc.login, errors)
+        self.assertGreater(TextCampaign.objects.filter(account=self.acc).count(), 0)
 
+    def test_load_data_sequential_errors(self):
+        # при обработке по очереди ошибки обрабатываются так же
+        errors = self.api.load_data(workers=1)
+        self.assertIn('unknown_login', errors)
+        self.assertNotIn(self.acc.login, errors)
@@ -0,0 +1,141 @@
+import threading
+import time
+
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from direct.scheduler import UnitsScheduler, LoginUnits, parse_units, is_units_error, BIDS_PRIORITY
+
+
+class UnitsError(Exception):
+    error_code = 152
+
+
+class FakeApi:
+    """
+    Имитирует учет баллов директа: у каждого логина суточный лимит, каждый запрос стоит cost баллов,
+    баллы восстанавливаются равномерно в течение суток
+    """
+    sandbox = True
+
+    def __init__(self, limit, cost=10):
+        self.limit = limit
+        self.cost = cost
+        self.rest = {}
+        self.updated_at = {}
+        self.calls = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def _spend(self, login, name):
+        with self.lock:
+            now = time.monotonic()
+            rest = self.rest.get(login, self.limit)
+            rest = min(self.limit, rest + (now - self.updated_at.get(login, now)) * self.limit / 86400)
+            self.updated_at[login] = now
+            if rest < self.cost:
+                self.rest[login] = rest
+                self.errors += 1
+                raise UnitsError('Error 152: not enough units')
+            self.rest[login] = rest - self.cost
+            self.calls.append(name)
+
+    def units_header(self, login):
+        return '%d/%d/%d' % (self.cost, self.rest[login], self.limit)
+
+    def get_keywords(self, params, client_login=None):
+        self._spend(client_login, 'get_keywords')
+        return []
+
+    def set_keywordbids(self, params, client_login=None):
+        self._spend(client_login, 'set_keywordbids')
+        return []
+
+    def reports(self, params, client_login=None):
+        self._spend(client_login, 'reports')
+        return []
+
+
+class TestUnitsScheduler(SimpleTestCase):
+
+    def test_parse_units(self):
+        self.assertEqual(parse_units('10/20828/64000'), (10, 20828, 64000))
+        self.assertTrue(is_units_error(UnitsError()))
+        self.assertFalse(is_units_error(ValueError('timeout')))
+        # у исключения нет кода, ошибка определяется по полю error_code или тексту ошибки
+        self.assertTrue(is_units_error(Exception("{'error_code': 152, 'error_string': 'Not enough units'}")))
+        self.assertTrue(is_units_error(Exception('Недостаточно баллов')))
+
+    def test_not_units_error(self):
+        # число 152 в тексте других ошибок не считается ошибкой баллов
+        for message in ['Campaign 152 not found', 'timeout after 152 ms', "{'error_code': 1520}",
+                        "{'error_code': 53, 'error_detail': 'Ids: [152]'}"]:
+            self.assertFalse(is_units_error(Exception(message)), message)
+        # код ошибки важнее текста
+        error = Exception('Not enough units')
+        error.error_code = 53
+        self.assertFalse(is_units_error(error))
+
+    def test_passthrough_attributes(self):
+        scheduler = UnitsScheduler(FakeApi(limit=1000))
+        self.assertTrue(scheduler.sandbox)
+
+    def test_paces_calls_without_errors(self):
+        # лимит 100 баллов в секунду, запрос 10 баллов: 30 запросов не помещаются в начальный остаток
+        api = FakeApi(limit=100 * 86400)
+        api.rest['login'] = 100
+        api.updated_at['login'] = time.monotonic()
+        scheduler = UnitsScheduler(api, units_reader=lambda api, login: api.units_header(login))
+        scheduler.update_units('login', '0/100/%d' % api.limit)
+
+        threads = [threading.Thread(target=scheduler.get_keywords, args=({},), kwargs={'client_login': 'login'})
+                   for _ in range(30)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(api.calls), 30)
+        self.assertEqual(api.errors, 0)
+
+    def test_retries_after_units_error(self):
+        api = FakeApi(limit=100 * 86400)
+        api.rest['login'] = 0
+        api.updated_at['login'] = time.monotonic()
+        scheduler = UnitsScheduler(api)
+        # планировщик считает, что баллы есть, а директ отвечает ошибкой 152
+        scheduler.update_units('login', '0/1000/%d' % api.limit)
+        scheduler.get_keywords({}, client_login='login')
+        self.assertEqual(api.calls, ['get_keywords'])
+        self.assertEqual(api.errors, 1)
+
+    def test_backoff_without_units_reader(self):
+        # лимит неизвестен: после ошибки 152 запрос повторяется после паузы, остаток остается неизвестным
+        api = FakeApi(limit=100 * 86400)
+        api.rest['login'] = 0
+        api.updated_at['login'] = time.monotonic()
+        scheduler = UnitsScheduler(api)
+        with mock.patch.object(LoginUnits, 'default_wait', 0.2):
+            started = time.monotonic()
+            scheduler.get_keywords({}, client_login='login')
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(api.calls, ['get_keywords'])
+        self.assertEqual(api.errors, 1)
+        self.assertIsNone(scheduler.units('login'))
+        self.assertEqual(scheduler._logins['login'].backoff, 0)
+
+    def test_priorities(self):
+        api = FakeApi(limit=100 * 86400)
+        scheduler = UnitsScheduler(api, max_concurrent=1)
+        # занимаем единственный слот, что бы запросы встали в очередь
+        scheduler._acquire('login', BIDS_PRIORITY, 0)
+        threads = []
+        for method in ['reports', 'get_keywords', 'set_keywordbids']:
+            t = threading.Thread(target=getattr(scheduler, method), args=({},), kwargs={'client_login': 'login'})
+            t.start()
+            threads.append(t)
+            time.sleep(0.05)
+        scheduler._release('login')
+        for t in threads:
+            t.join()
+        self.assertEqual(api.calls, ['set_keywordbids', 'get_keywords', 'reports'])